@@ -30,7 +30,8 @@
     module (see the included examples). Aside from the app class, you
     may want to include TITLE and/or CLASS_NAME strings; TITLE is the
     display title, and CLASS_NAME is the name of your main app class.
-    (Both will be derived from the module name if absent.)
+    (Both will be derived from the module name if absent.) start.py 
+    looks these up once, at startup.
 
     startup() is called first, before any events are handled; then the
     event loop runs until either it's out of events (i.e. the socket
@@ -53,9 +54,13 @@ __author__ = 'William McBrine <wmcbrine@gmail.com>'
 __version__ = '0.20'
 __license__ = 'LGPL'
 
+import os
 import time
+import select
 import string
 import struct
+import thread
+from collections import deque
 
 #--- Constants --------------------------------------------------------
 #
@@ -288,6 +293,19 @@ _EVT_FONT_INFO = 6
 _EVT_INIT_INFO = 7
 _EVT_RESOLUTION_INFO = 8
 
+# Names for reporting
+
+_CMD_NAMES = dict((value, name[5:].lower())
+                  for name, value in globals().items()
+                  if name.startswith('_CMD_'))
+_EVT_NAMES = dict((value, name[5:].lower())
+                  for name, value in globals().items()
+                  if name.startswith('_EVT_'))
+
+# First byte of an encoded _EVT_RSRC_INFO event
+
+_RSRC_INFO_TAG = chr(_EVT_RSRC_INFO | 0x80)
+
 # Characters for codes returned by QWERTY input
 
 _QWERTY_MAP = string.uppercase + "-=[]\;',./` "
@@ -404,6 +422,20 @@ class _EventData:
 
         return [func[i]() for i in format]
 
+def _progress_key(data):
+    """ Return what identifies an encoded _EVT_RSRC_INFO event as a 
+        progress update -- the resource, the status and the info keys, 
+        but not their values -- or None for an error, which should never
+        be dropped.
+
+    """
+    ev = _EventData(data)
+    evnum, resource, status, count = ev.unpack('iiii')
+    if status == RSRC_STATUS_ERROR:
+        return None
+    keys = frozenset(ev.unpack('ss')[0] for i in xrange(count))
+    return resource, status, keys
+
 def _get_chunked(stream):
     """ Read HME-style chunked event data from the input stream. """
     data = ''
@@ -424,6 +456,162 @@ def _get_chunked(stream):
         except:
             return None
 
+class _EventReader:
+    """ Read HME-style chunked event data from the input stream, in
+        batches. Rather than reading each chunk length and chunk
+        separately, this receives as much as is available into a
+        preallocated buffer, and returns all the complete events it
+        finds there at once.
+
+        If the stream is a socket, or a socket file object (as with
+        start.py), it's read directly via recv_into(), starting with
+        anything the file object had already buffered. (Any object with
+        recv_into() will do; if select() can't be used on it, it needs
+        a ready() method as well.) Otherwise, if the stream has a file 
+        descriptor, that's read via os.read() -- so nothing else should
+        read the stream through its own buffer, before or after; use 
+        read() here for the handshake. Failing all that, it falls back
+        to read() calls of exactly the size needed -- which means only
+        one event is returned at a time, so the coalescing options in 
+        Application have no effect.
+
+        EOF (or a socket error) at an event boundary sets eof; if it
+        comes in the middle of an event, truncated is also set.
+
+    """
+    BUFSIZE = 0x10000
+
+    def __init__(self, stream, bufsize=BUFSIZE):
+        self.stream = stream
+        self.buf = bytearray(bufsize)
+        self.start = 0  # Start of unparsed data
+        self.end = 0    # End of received data
+        self.eof = False
+        self.truncated = False
+        self.sock = None
+        self.fd = None
+        if hasattr(stream, 'recv_into'):
+            self.sock = stream
+        else:
+            sock = getattr(stream, '_sock', None)
+            rbuf = getattr(stream, '_rbuf', None)
+            if hasattr(sock, 'recv_into') and rbuf is not None:
+                # A socket._fileobject -- take over its socket, but
+                # keep what it's already read.
+                pending = rbuf.getvalue()
+                rbuf.seek(0)
+                rbuf.truncate()
+                self.buf[:len(pending)] = pending
+                self.end = len(pending)
+                self.sock = sock
+            else:
+                try:
+                    self.fd = stream.fileno()
+                except (AttributeError, EnvironmentError, ValueError):
+                    pass
+
+    def _parse(self):
+        """ Return a list of the complete events in the buffer, and 
+            the number of unparsed bytes needed to get any further.
+
+        """
+        buf = self.buf
+        end = self.end
+        events = []
+        pos = self.start
+        while True:
+            chunks = []
+            index = pos
+            while True:
+                if end - index < 2:
+                    return events, index + 2 - pos
+                length = (buf[index] << 8) | buf[index + 1]
+                index += 2
+                if not length:
+                    break
+                if end - index < length:
+                    return events, index + length - pos
+                chunks.append(str(buf[index:index + length]))
+                index += length
+            events.append(''.join(chunks))
+            pos = self.start = index
+
+    def _ready(self):
+        """ Check whether data can be read without blocking. """
+        source = self.sock
+        if source is None:
+            source = self.fd
+        elif hasattr(source, 'ready'):
+            return source.ready()
+        if source is None:
+            return False
+        try:
+            return bool(select.select([source], [], [], 0)[0])
+        except (EnvironmentError, select.error, ValueError, TypeError):
+            return True
+
+    def _fill(self, need):
+        """ Receive more data, making sure there's room for at least 
+            "need" bytes of unparsed data. Returns False at EOF.
+
+        """
+        buf = self.buf
+        unparsed = self.end - self.start
+        if self.start:
+            if unparsed:
+                buf[:unparsed] = buf[self.start:self.end]
+            self.start = 0
+            self.end = unparsed
+        if need > len(buf):
+            buf.extend(bytearray(need - len(buf)))
+        try:
+            if self.sock:
+                count = self.sock.recv_into(memoryview(buf)[self.end:])
+            elif self.fd is not None:
+                data = os.read(self.fd, len(buf) - self.end)
+                count = len(data)
+                buf[self.end:self.end + count] = data
+            else:
+                data = self.stream.read(need - unparsed)
+                count = len(data)
+                buf[self.end:self.end + count] = data
+        except (EnvironmentError, ValueError):
+            count = 0
+        if not count:
+            self.eof = True
+            self.truncated = self.end > self.start
+            return False
+        self.end += count
+        return True
+
+    def read(self, size):
+        """ Return the next size bytes as they are, not as events (or 
+            less, at EOF). This is for the handshake.
+
+        """
+        while self.end - self.start < size and not self.eof:
+            if not self._fill(size):
+                break
+        data = str(self.buf[self.start:min(self.end, self.start + size)])
+        self.start += len(data)
+        return data
+
+    def read_events(self, block=True):
+        """ Return a list of complete events (as strings). If none are
+            buffered, then if block is True, wait for at least one (an
+            empty list means EOF); otherwise, only take what's already
+            available.
+
+        """
+        events, need = self._parse()
+        while not events and not self.eof:
+            if not block and not self._ready():
+                break
+            if not self._fill(need):
+                break
+            events, need = self._parse()
+        return events
+
 def _pack_bool(value):
     """ bool to HME boolean """
     return chr(value)
@@ -528,6 +716,116 @@ def _put_chunked(stream, data):
     except:
         pass
 
+class _Stats:
+    """ Per-session counters, kept by each Application as app.stats, 
+        and updated as commands are sent and events handled. Use 
+        Application.get_stats() for a readable copy.
+
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.commands = {}
+        self.bytes = 0
+        self.flushes = 0
+        self.events = {}
+        self.handler_time = {}
+        self.resources = {}
+
+    def command(self, cmd, obj, size):
+        """ Count a command of the given size (before framing) for obj.
+            Resources are tracked from their _CMD_RSRC_ADD_* to their
+            _CMD_RSRC_REMOVE.
+
+        """
+        self.commands[cmd] = self.commands.get(cmd, 0) + 1
+        self.bytes += size + 2 * ((size + 0xfffd) // 0xfffe) + 2
+        if _CMD_RSRC_ADD_COLOR <= cmd <= _CMD_RSRC_ADD_ANIM:
+            self.resources[obj.id] = obj.__class__.__name__
+        elif cmd == _CMD_RSRC_REMOVE:
+            self.resources.pop(obj.id, None)
+
+    def event(self, evnum, elapsed):
+        """ Count an event, and the time taken to handle it. """
+        self.events[evnum] = self.events.get(evnum, 0) + 1
+        self.handler_time[evnum] = self.handler_time.get(evnum, 0) + elapsed
+
+    def snapshot(self, app):
+        resources = {}
+        for name in self.resources.values():
+            resources[name] = resources.get(name, 0) + 1
+        views = 0
+        stack = [app.root]
+        while stack:
+            view = stack.pop()
+            views += 1
+            stack.extend(view.children)
+        return {'commands': dict((_CMD_NAMES.get(cmd, cmd), count)
+                                 for cmd, count in self.commands.items()),
+                'bytes': self.bytes,
+                'flushes': self.flushes,
+                'events': dict((_EVT_NAMES.get(evnum, evnum), count)
+                               for evnum, count in self.events.items()),
+                'handler_time': dict((_EVT_NAMES.get(evnum, evnum), elapsed)
+                                     for evnum, elapsed in
+                                     self.handler_time.items()),
+                'resources': resources,
+                'views': views,
+                'age': time.time() - self.start}
+
+    def summary(self, app):
+        """ One-line summary, for logging. """
+        stats = self.snapshot(app)
+        return ('%d commands (%d bytes), %d flushes, %d events '
+                '(%.3fs in handlers), %d views, %d resources' %
+                (sum(stats['commands'].values()), stats['bytes'],
+                 stats['flushes'], sum(stats['events'].values()),
+                 sum(stats['handler_time'].values()), stats['views'],
+                 sum(stats['resources'].values())))
+
+class Tracer:
+    """ Records timed spans -- startup(), each event handled, each 
+        command sent, and each flush -- for an Application whose tracer
+        attribute is set to one of these. save() writes them out in the 
+        Chrome trace event format, which can be loaded into a trace 
+        viewer (e.g. chrome://tracing).
+
+        Only the latest max_spans spans are kept, so that a long session
+        can't use up memory; dropped counts the rest.
+
+    """
+    MAX_SPANS = 100000
+
+    def __init__(self, max_spans=MAX_SPANS):
+        self.spans = deque(maxlen=max_spans)
+        self.dropped = 0
+
+    def add(self, name, start, end, args=None):
+        """ Record a span, with times from time.time(). """
+        if len(self.spans) == self.spans.maxlen:
+            self.dropped += 1
+        self.spans.append((name, start, end, thread.get_ident(), args))
+
+    def events(self):
+        """ Return the spans as a list of trace event dicts. """
+        pid = os.getpid()
+        result = []
+        for name, start, end, tid, args in self.spans:
+            event = {'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                     'ts': int(start * 1e6), 'dur': int((end - start) * 1e6)}
+            if args:
+                event['args'] = args
+            result.append(event)
+        return result
+
+    def save(self, path):
+        """ Write the trace to the named file, as JSON. """
+        import json
+        f = open(path, 'w')
+        json.dump({'traceEvents': self.events(),
+                   'displayTimeUnit': 'ms',
+                   'otherData': {'droppedSpans': self.dropped}}, f)
+        f.close()
+
 #--- Resource classes -------------------------------------------------
 
 class _HMEObject:
@@ -553,8 +851,16 @@ class _HMEObject:
             according to the format string.
 
         """
-        _put_chunked(self.app.wfile,
-                     _pack('ii' + format, cmd, self.id, *params))
+        data = _pack('ii' + format, cmd, self.id, *params)
+        self.app.stats.command(cmd, self, len(data))
+        if self.app.tracer:
+            start = time.time()
+            _put_chunked(self.app.wfile, data)
+            self.app.tracer.add(_CMD_NAMES.get(cmd, 'command'), start,
+                                time.time(), {'id': self.id,
+                                              'bytes': len(data)})
+        else:
+            _put_chunked(self.app.wfile, data)
 
 class Resource(_HMEObject):
     """ Base class for Resources
@@ -575,19 +881,30 @@ class Resource(_HMEObject):
     def set_speed(self, speed):
         self.put(_CMD_RSRC_SET_SPEED, 'f', speed)
         self.speed = speed
-        try:
-            self.app.wfile.flush()
-        except:
-            pass
+        self.app.flush()
 
     def close(self):
         self.put(_CMD_RSRC_CLOSE)
 
     def remove(self):
         if self.id >= ID_CLIENT:
+            self.app.rsrc_handlers.pop(self.id, None)
             self.put(_CMD_RSRC_REMOVE)
             self.id = -1
 
+    def set_info_handler(self, handler=None):
+        """ Have handler(resource, status, info) called for this 
+            resource's _EVT_RSRC_INFO events, instead of the app's 
+            handle_resource_info(); resource is this object. Use None to
+            go back to the default. Note that the app keeps a reference 
+            to the resource while a handler is set, or until remove().
+
+        """
+        if handler is None:
+            self.app.rsrc_handlers.pop(self.id, None)
+        else:
+            self.app.rsrc_handlers[self.id] = (self, handler)
+
     def play(self):
         self.set_speed(1)
 
@@ -777,11 +1094,15 @@ class Stream(Resource):
         it doesn't seem to be used. The default is to play the stream 
         automatically when the event is sent; you can change this by 
         specifying "play=False". However, streams seem to be playable 
-        only once.
+        only once. A handler for the stream's status events can be
+        given here, or later via set_info_handler().
 
     """
-    def __init__(self, app, url, mime='', play=True, params={}):
+    def __init__(self, app, url, mime='', play=True, params={},
+                 handler=None):
         Resource.__init__(self, app)
+        if handler:
+            self.set_info_handler(handler)
         self.put(_CMD_RSRC_ADD_STREAM, 'ssbd', url, mime, play, params)
         self.speed = int(play)
 
@@ -1079,10 +1400,33 @@ class Application(Resource):
         context; alternatively, you can pass infile and outfile, and
         (potentially) start the app from the command line.
 
+        If coalesce_repeats is set True (in your subclass, or before 
+        the event loop starts), then when several identical KEY_REPEAT 
+        events are waiting to be handled, they're merged into one, and 
+        self.repeat_count is set to the number merged. Otherwise, 
+        repeat_count is always 1. (Coalescing needs an input stream that
+        can be read in batches -- a socket, socket file object or file 
+        descriptor; see _EventReader.)
+
+        Similarly, with coalesce_rsrc_info (on by default), when a 
+        batch of incoming events includes several _EVT_RSRC_INFO events 
+        that differ only in their info values -- same resource, same 
+        status, same info keys (i.e., progress updates) -- only the last
+        of them is handled. Errors are never dropped.
+
+        To profile an app, set its tracer to a Tracer object before 
+        calling mainloop().
+
     """
+    coalesce_repeats = False
+    coalesce_rsrc_info = True
+    tracer = None
+
     def __init__(self, infile=None, outfile=None, context=None):
         Resource.__init__(self, self, ID_ROOT_STREAM)
 
+        self.stats = _Stats()
+
         self.resnum = ID_CLIENT
 
         self.context = context
@@ -1093,6 +1437,9 @@ class Application(Resource):
             self.rfile = infile
             self.wfile = outfile
 
+        # Resources with their own _EVT_RSRC_INFO handlers, by id
+        self.rsrc_handlers = {}
+
         # Resource caches
         self.colors = {}
         self.ttfs = {}
@@ -1118,10 +1465,18 @@ class Application(Resource):
         self.wfile.write('SBTV\0\0%c%c' % (chr(HME_MAJOR_VERSION),
                                            chr(HME_MINOR_VERSION)))
         self.wfile.flush()
-        self.answer = self.rfile.read(8)
+        # Incoming events are read in batches, and queued here. The 
+        # handshake goes through the reader too, since it may take over
+        # the stream.
+        self.reader = _EventReader(self.rfile)
+        self.answer = self.reader.read(8)
         # self.answer[-2:] contains the reciever's supported HME 
         # version, if you care. (I get 0.45 with TiVo 9.2.)
 
+        self.pending = deque()
+        self.truncated = False  # Set if the stream ends mid-event
+        self.repeat_count = 1
+
         # The root view object
         self.root = View(self, id=ID_ROOT_VIEW)
 
@@ -1134,7 +1489,10 @@ class Application(Resource):
             return
 
         self.active = True
+        start = time.time()
         self.startup()
+        if self.tracer:
+            self.tracer.add('startup', start, time.time())
         self.root.set_visible()
 
         # Run events until there are no more, or until self.active is 
@@ -1150,6 +1508,31 @@ class Application(Resource):
         while self.get_event():
             pass
 
+        if hasattr(self.context, 'log_message'):
+            self.context.log_message('Stats: %s', self.stats.summary(self))
+
+    def flush(self):
+        """ Flush the output buffer. Returns False on error. """
+        self.stats.flushes += 1
+        start = time.time()
+        try:
+            self.wfile.flush()
+        except:
+            return False
+        if self.tracer:
+            self.tracer.add('flush', start, time.time())
+        return True
+
+    def get_stats(self):
+        """ Return a snapshot of this session's counters, as a dict: 
+            commands (by name), bytes (written, including framing), 
+            flushes, events (by name), handler_time (in seconds, by 
+            event name), resources (live, by class name), views (live, 
+            including the root), and the session's age in seconds.
+
+        """
+        return self.stats.snapshot(self)
+
     def next_resnum(self):
         """ Return the next available resource ID number, starting from 
             ID_CLIENT.
@@ -1164,15 +1547,26 @@ class Application(Resource):
             event; returns False if it can't. Otherwise, unpacks the 
             event data, calls the handler function (see below), 
             processes the return value (in the case of _EVT_IDLE or 
-            _EVT_RESOLUTION_INFO), and returns True.
+            _EVT_RESOLUTION_INFO), and returns True. If the stream ends
+            partway through an event, self.truncated is set, and that's
+            logged, rather than passing for a clean end.
 
         """
-        try:
-            self.wfile.flush()
-        except:
+        if not self.flush():
             return False
 
-        data = _get_chunked(self.rfile)
+        if not self.pending:
+            self._queue(self.reader.read_events())
+            if not self.pending:
+                if self.reader.truncated and not self.truncated:
+                    # Not a clean end -- the receiver (or the network) 
+                    # went away partway through sending an event.
+                    self.truncated = True
+                    if hasattr(self.context, 'log_message'):
+                        self.context.log_message(
+                            'Event stream truncated mid-event')
+                return False
+        data = self.pending.popleft()
         if not data:
             return False
 
@@ -1180,13 +1574,42 @@ class Application(Resource):
 
         evnum, resource = ev.unpack('ii')
 
+        start = time.time()
+        try:
+            return self._dispatch(evnum, resource, ev, data)
+        finally:
+            end = time.time()
+            self.stats.event(evnum, end - start)
+            if self.tracer:
+                self._trace_event(evnum, resource, data, start, end)
+
+    def _trace_event(self, evnum, resource, data, start, end):
+        """ Add a span for an event to the tracer. """
+        name = _EVT_NAMES.get(evnum, 'event')
+        args = {'resource': resource}
+        if evnum == _EVT_KEY:
+            action, keynum, rawcode = _EventData(data).unpack('iiiii')[2:]
+            name = {KEY_PRESS: 'key_press', KEY_REPEAT: 'key_repeat',
+                    KEY_RELEASE: 'key_release'}.get(action, name)
+            args.update({'keynum': keynum, 'rawcode': rawcode})
+        self.tracer.add(name, start, end, args)
+
+    def _dispatch(self, evnum, resource, ev, data):
+        """ Handle one event, for get_event(). ev is an _EventData
+            object, already past the event number and resource id; data
+            is the original event data.
+
+        """
         if evnum == _EVT_KEY:
             action, keynum, rawcode = ev.unpack('iii')
 
+            self.repeat_count = 1
             if action == KEY_PRESS:
                 handle = getattr(self.focus, 'handle_key_press',
                                  self.handle_key_press)
             elif action == KEY_REPEAT:
+                if self.coalesce_repeats:
+                    self.repeat_count += self._coalesce(data)
                 handle = getattr(self.focus, 'handle_key_repeat',
                                  self.handle_key_repeat)
             elif action == KEY_RELEASE:
@@ -1234,9 +1657,13 @@ class Application(Resource):
             for i in xrange(count):
                 key, value = ev.unpack('ss')
                 info[key] = value
-            handle = getattr(self.focus, 'handle_resource_info',
-                             self.handle_resource_info)
-            handle(resource, status, info)
+            if resource in self.rsrc_handlers:
+                rsrc, handle = self.rsrc_handlers[resource]
+                handle(rsrc, status, info)
+            else:
+                handle = getattr(self.focus, 'handle_resource_info',
+                                 self.handle_resource_info)
+                handle(resource, status, info)
 
         elif evnum == _EVT_IDLE:
             idle = ev.unpack('b')[0]
@@ -1284,6 +1711,41 @@ class Application(Resource):
 
         return True
 
+    def _queue(self, events):
+        """ Add a batch of events to the pending queue. If 
+            coalesce_rsrc_info is set, an _EVT_RSRC_INFO progress update
+            is dropped when a later one in the batch has the same 
+            resource, status and info keys.
+
+        """
+        if self.coalesce_rsrc_info and len(events) > 1:
+            seen = set()
+            kept = []
+            for data in reversed(events):
+                if data[:1] == _RSRC_INFO_TAG:
+                    key = _progress_key(data)
+                    if key in seen:
+                        continue
+                    if key:
+                        seen.add(key)
+                kept.append(data)
+            kept.reverse()
+            events = kept
+        self.pending.extend(events)
+
+    def _coalesce(self, data):
+        """ Pick up any events that have arrived since the last read,
+            then drop queued copies of the event (data) that come next
+            in line. Returns the number dropped.
+
+        """
+        self._queue(self.reader.read_events(False))
+        count = 0
+        while self.pending and self.pending[0] == data:
+            self.pending.popleft()
+            count += 1
+        return count
+
     def send_key(self, keynum, rawcode=0, animation=None, animtime=0):
         """ Send a key event to the TiVo, for it to send back to us 
             later.
@@ -1296,10 +1758,7 @@ class Application(Resource):
                 animation = self.immediate
         self.put(_CMD_RSRC_SEND_EVENT, 'iiiiii', animation.id, _EVT_KEY,
                  self.id, KEY_PRESS, keynum, rawcode)
-        try:
-            self.wfile.flush()
-        except:
-            pass
+        self.flush()
 
     def set_focus(self, focus):
         """ Set the focus to a new object, and notify both the old and
@@ -1319,9 +1778,7 @@ class Application(Resource):
 
     def sleep(self, interval):
         """ Flush the write buffer, then sleep for interval seconds. """
-        try:
-            self.wfile.flush()
-        except:
+        if not self.flush():
             self.active = False
         time.sleep(interval)
 
@@ -1398,7 +1855,11 @@ class Application(Resource):
         pass
 
     def handle_key_repeat(self, keynum, rawcode=None):
-        """ Override this to handle key repeats. (_EVT_KEY, KEY_REPEAT) """
+        """ Override this to handle key repeats. (_EVT_KEY, KEY_REPEAT)
+            If coalesce_repeats is set, self.repeat_count says how many
+            repeats this call stands for.
+
+        """
         self.handle_key_press(keynum, rawcode)
 
     def handle_key_release(self, keynum, rawcode=None):
@@ -1424,7 +1885,9 @@ class Application(Resource):
     def handle_resource_info(self, resource, status, info):
         """ Override this if you want to handle _EVT_RSRC_INFO. resource 
             is the resource id number, status is the status code, and 
-            info is a dict with whatever else the event returned.
+            info is a dict with whatever else the event returned. Events
+            for resources with their own handlers (see 
+            Resource.set_info_handler()) don't come here.
 
         """
         pass
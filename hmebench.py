@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+# HME Codec Benchmarks for Python, v0.20
+# Copyright 2012 William McBrine
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You didn't receive a copy of the license with this library because
+# you already have dozens of copies, don't you? If not, visit gnu.org.
+
+""" HME Codec Benchmarks for Python
+
+    Times the encoding and decoding functions in the hme module, on
+    typical commands and events, and saves the results as JSON, so that
+    changes to the codec can be compared.
+
+    Command-line usage:
+
+    ./hmebench.py [options] [benchmark] [benchmark] ...
+
+    -o, --output      Save the results to this file (JSON).
+    -c, --compare     Compare with results saved earlier.
+    -t, --threshold   With -c, the slowdown ratio counted as a
+                      regression (default 1.1). If there are any, the
+                      exit status is 1.
+    -r, --repeat      Number of timing runs per benchmark; the best is
+                      kept (default 5).
+    -l, --list        List the benchmarks and exit.
+    -h, --help        Print help and exit.
+
+    By default, all the benchmarks are run.
+
+"""
+
+__author__ = 'William McBrine <wmcbrine@gmail.com>'
+__version__ = '0.20'
+__license__ = 'LGPL'
+
+import getopt
+import json
+import platform
+import socket
+import sys
+import time
+import timeit
+from cStringIO import StringIO
+
+import hme
+
+class _NullFile:
+    """ Output stream that discards everything. """
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+def _chunked(data):
+    out = StringIO()
+    hme._put_chunked(out, data)
+    return out.getvalue()
+
+# Sample data
+
+_TRANSITION_PARAMS = {'title': u'Caf\xe9 \xe0 la carte',
+                      'items': ['one', 'two', 'three', 'four'],
+                      'state': {'page': '3', 'focus': '7',
+                                'history': [{'page': '1'}, {'page': '2'}]},
+                      'flags': ['a', {'b': 'c', 'd': ['e', 'f']}]}
+
+_SMALL = hme._pack('iiiiiiib', hme._CMD_VIEW_ADD, 2049, 2, 32, 24, 576,
+                   432, True)
+_LARGE = 'x' * (4 * 1024 * 1024)
+
+_KEY_EVENT = hme._pack('iiiii', hme._EVT_KEY, hme.ID_ROOT_STREAM,
+                       hme.KEY_PRESS, hme.KEY_RIGHT, 0x2300)
+
+_FONT_FORMAT = 'iiffffii' + 'iff' * 95
+_FONT_VALUES = [hme._EVT_FONT_INFO, 2050, 19.2, 4.8, 28.8, 4.8, 3, 95]
+for _glyph in xrange(32, 127):
+    _FONT_VALUES.extend((_glyph, 12.0, 11.5))
+_FONT_EVENT = hme._pack(_FONT_FORMAT, *_FONT_VALUES)
+
+_RESOLUTIONS = [(1280, 720, 1, 1), (704, 480, 40, 33), (640, 480, 1, 1),
+                (1920, 1080, 1, 1)]
+_RES_VALUES = [hme._EVT_RESOLUTION_INFO, hme.ID_ROOT_STREAM, 4, 640, 480,
+               1, 1, len(_RESOLUTIONS)]
+for _res in _RESOLUTIONS:
+    _RES_VALUES.extend(_res)
+_RES_EVENT = hme._pack('i' * len(_RES_VALUES), *_RES_VALUES)
+
+_KEY_BATCH = _chunked(_KEY_EVENT) * 100
+
+_SOCKETS = socket.socketpair()
+
+# The benchmarks -- each is (name, function, calls per timing run)
+
+def _pack_view_add():
+    hme._pack('iiiiiiib', hme._CMD_VIEW_ADD, 2049, 2, 32, 24, 576, 432, True)
+
+def _pack_set_bounds():
+    hme._pack('iiiiiii', hme._CMD_VIEW_SET_BOUNDS, 2049, 100, -50, 320,
+              240, 2100)
+
+def _pack_set_scale():
+    hme._pack('iiffi', hme._CMD_VIEW_SET_SCALE, 2049, 1.5, 0.75, 2100)
+
+def _pack_add_text():
+    hme._pack('iiiis', hme._CMD_RSRC_ADD_TEXT, 2060, 2050, 2051,
+              u'Now Playing: Caf\xe9 Society')
+
+def _pack_dict():
+    hme._pack_dict(_TRANSITION_PARAMS)
+
+def _put_chunked_small():
+    hme._put_chunked(_NullFile(), _SMALL)
+
+def _put_chunked_large():
+    hme._put_chunked(_NullFile(), _LARGE)
+
+def _get_chunked_key():
+    hme._get_chunked(StringIO(_chunked(_KEY_EVENT)))
+
+def _read_events_batch():
+    # From a StringIO, the reader falls back to one event per call
+    reader = hme._EventReader(StringIO(_KEY_BATCH))
+    while reader.read_events():
+        pass
+
+def _read_events_socket():
+    # Includes sending the keys, but they're read in one batch
+    _SOCKETS[0].sendall(_KEY_BATCH)
+    reader = hme._EventReader(_SOCKETS[1])
+    count = 0
+    while count < 100:
+        count += len(reader.read_events())
+
+def _unpack_key():
+    hme._EventData(_KEY_EVENT).unpack('iiiii')
+
+def _unpack_font_info():
+    ev = hme._EventData(_FONT_EVENT)
+    ev.unpack('iiffffii')
+    for i in xrange(95):
+        ev.unpack('iff')
+
+def _unpack_resolution():
+    ev = hme._EventData(_RES_EVENT)
+    ev.unpack('iii')
+    ev.unpack('iiii')
+    count = ev.unpack('i')[0]
+    for i in xrange(count):
+        ev.unpack('iiii')
+
+BENCHMARKS = [('pack_view_add', _pack_view_add, 20000),
+              ('pack_set_bounds', _pack_set_bounds, 20000),
+              ('pack_set_scale', _pack_set_scale, 20000),
+              ('pack_add_text', _pack_add_text, 20000),
+              ('pack_dict', _pack_dict, 5000),
+              ('put_chunked_small', _put_chunked_small, 20000),
+              ('put_chunked_4mb', _put_chunked_large, 20),
+              ('get_chunked_key', _get_chunked_key, 20000),
+              ('read_events_100_keys', _read_events_batch, 500),
+              ('read_events_sock_100', _read_events_socket, 500),
+              ('unpack_key', _unpack_key, 20000),
+              ('unpack_font_info', _unpack_font_info, 200),
+              ('unpack_resolution', _unpack_resolution, 5000)]
+
+def run(names=None, repeat=5):
+    """ Run the named benchmarks (or all), and return a dict of the
+        results, with the best time per call for each, in microseconds.
+
+    """
+    results = {}
+    for name, func, calls in BENCHMARKS:
+        if names and name not in names:
+            continue
+        best = min(timeit.Timer(func).repeat(repeat, calls))
+        results[name] = {'usec': best / calls * 1e6, 'calls': calls,
+                         'repeat': repeat}
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'hme_version': hme.__version__,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'results': results}
+
+def compare(old, new, threshold=1.1):
+    """ Print a comparison of two result sets. Returns the names of the
+        benchmarks that got slower by more than the threshold ratio.
+
+    """
+    regressions = []
+    for name in sorted(new['results']):
+        if name not in old['results']:
+            continue
+        before = old['results'][name]['usec']
+        after = new['results'][name]['usec']
+        ratio = after / before
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print '%-22s %12.3f %12.3f %7.2fx%s' % (name, before, after, ratio,
+                                               flag)
+    return regressions
+
+if __name__ == '__main__':
+    output = None
+    baseline = None
+    threshold = 1.1
+    repeat = 5
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'o:c:t:r:lh',
+                                   ['output=', 'compare=', 'threshold=',
+                                    'repeat=', 'list', 'help'])
+    except getopt.GetoptError, msg:
+        print msg
+        sys.exit(1)
+
+    for opt, value in opts:
+        if opt in ('-o', '--output'):
+            output = value
+        elif opt in ('-c', '--compare'):
+            baseline = value
+        elif opt in ('-t', '--threshold'):
+            threshold = float(value)
+        elif opt in ('-r', '--repeat'):
+            repeat = int(value)
+        elif opt in ('-l', '--list'):
+            for name, func, calls in BENCHMARKS:
+                print name
+            sys.exit()
+        elif opt in ('-h', '--help'):
+            print __doc__
+            sys.exit()
+
+    results = run(args, repeat)
+
+    if output:
+        f = open(output, 'w')
+        json.dump(results, f, indent=1, sort_keys=True)
+        f.close()
+
+    if baseline:
+        print '%-22s %12s %12s %8s' % ('benchmark', 'before usec',
+                                       'after usec', 'ratio')
+        if compare(json.load(open(baseline)), results, threshold):
+            sys.exit(1)
+    else:
+        for name in sorted(results['results']):
+            print '%-22s %12.3f usec' % (name,
+                                         results['results'][name]['usec'])
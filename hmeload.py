@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+# HME Load Generator for Python, v0.20
+# Copyright 2012 William McBrine
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You didn't receive a copy of the license with this library because
+# you already have dozens of copies, don't you? If not, visit gnu.org.
+
+""" HME Load Generator for Python
+
+    Runs increasing numbers of simulated receivers (see hmesim.py) at
+    once against a running start.py, to see how many it can sustain.
+    Each client, for each round, fetches the TiVoConnect listing, the
+    icons it lists and any extra files, and then runs a session with
+    the given app and keys.
+
+    For each level of concurrency, it reports sessions per second,
+    median and 99th percentile latency from a key to the first command
+    back, commands per second, file fetches, errors, and (with -P) the
+    server's resident memory.
+
+    Command-line usage:
+
+    ./hmeload.py [options] <app> [key] [key] ...
+
+    -a, --address     Address of the server (default 127.0.0.1).
+    -p, --port        Port of the server (default 9042).
+    -n, --clients     Comma-separated levels of concurrency to run
+                      (default 1,5,10,20).
+    -r, --rounds      Sessions per client at each level (default 1).
+    -i, --interval    Seconds between keys (default 0.1).
+    -l, --linger      Seconds to wait after the last key (default 0.5).
+    -f, --files       Comma-separated extra paths to fetch each round.
+    -P, --pid         Process id of the server, for memory reporting.
+    -h, --help        Print help and exit.
+
+    Keys are as for hmesim.py.
+
+"""
+
+__author__ = 'William McBrine <wmcbrine@gmail.com>'
+__version__ = '0.20'
+__license__ = 'LGPL'
+
+import getopt
+import httplib
+import re
+import sys
+import threading
+import time
+
+import hmesim
+
+_URL_RE = re.compile(r'<Url>([^<]*)</Url>')
+
+def percentile(values, fraction):
+    """ Return the given fraction (0-1) percentile of a sorted list. """
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def server_rss(pid):
+    """ Return the resident memory of a process in KB, from /proc. """
+    try:
+        for line in open('/proc/%d/status' % pid):
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+    return 0
+
+class Client(threading.Thread):
+    """ One simulated receiver, run for a number of rounds. """
+    def __init__(self, host, port, app, keys, rounds, interval, linger,
+                 files):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.host = host
+        self.port = port
+        self.app = app
+        self.keys = keys
+        self.rounds = rounds
+        self.interval = interval
+        self.linger = linger
+        self.files = files
+
+        self.sessions = 0
+        self.commands = 0
+        self.fetches = 0
+        self.fetch_bytes = 0
+        self.errors = 0
+        self.latencies = []
+
+    def fetch(self, path):
+        """ GET a path, returning the body, or None on error. """
+        try:
+            conn = httplib.HTTPConnection(self.host, self.port)
+            conn.request('GET', path)
+            response = conn.getresponse()
+            body = response.read()
+            conn.close()
+        except Exception:
+            self.errors += 1
+            return None
+        if response.status != 200:
+            self.errors += 1
+            return None
+        self.fetches += 1
+        self.fetch_bytes += len(body)
+        return body
+
+    def run(self):
+        for i in xrange(self.rounds):
+            listing = self.fetch('/TiVoConnect?Command=QueryContainer')
+            if listing:
+                for url in _URL_RE.findall(listing):
+                    if url.endswith('.png'):
+                        self.fetch(url)
+            for path in self.files:
+                self.fetch(path)
+
+            receiver = hmesim.Receiver(self.host, self.port,
+                                       '/%s/' % self.app)
+            try:
+                receiver.run(self.keys, self.interval, self.linger)
+            except Exception:
+                self.errors += 1
+                continue
+            if not receiver.commands:
+                self.errors += 1
+                continue
+            self.sessions += 1
+            self.commands += receiver.commands
+            self.latencies.extend(receiver.latencies)
+
+def run_level(count, host, port, app, keys, rounds, interval, linger,
+              files):
+    """ Run count clients at once, and return a dict of results. """
+    clients = [Client(host, port, app, keys, rounds, interval, linger,
+                      files) for i in xrange(count)]
+    start = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start
+
+    latencies = []
+    for client in clients:
+        latencies.extend(client.latencies)
+    latencies.sort()
+    sessions = sum(client.sessions for client in clients)
+    commands = sum(client.commands for client in clients)
+    return {'clients': count,
+            'sessions': sessions,
+            'sessions_per_sec': sessions / elapsed,
+            'latency_p50': percentile(latencies, 0.5),
+            'latency_p99': percentile(latencies, 0.99),
+            'commands_per_sec': commands / elapsed,
+            'fetches': sum(client.fetches for client in clients),
+            'fetch_bytes': sum(client.fetch_bytes for client in clients),
+            'errors': sum(client.errors for client in clients),
+            'elapsed': elapsed}
+
+if __name__ == '__main__':
+    host = '127.0.0.1'
+    port = 9042
+    levels = [1, 5, 10, 20]
+    rounds = 1
+    interval = 0.1
+    linger = 0.5
+    files = []
+    pid = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'a:p:n:r:i:l:f:P:h',
+                                   ['address=', 'port=', 'clients=',
+                                    'rounds=', 'interval=', 'linger=',
+                                    'files=', 'pid=', 'help'])
+    except getopt.GetoptError, msg:
+        print msg
+        sys.exit(1)
+
+    for opt, value in opts:
+        if opt in ('-a', '--address'):
+            host = value
+        elif opt in ('-p', '--port'):
+            port = int(value)
+        elif opt in ('-n', '--clients'):
+            levels = [int(x) for x in value.split(',')]
+        elif opt in ('-r', '--rounds'):
+            rounds = int(value)
+        elif opt in ('-i', '--interval'):
+            interval = float(value)
+        elif opt in ('-l', '--linger'):
+            linger = float(value)
+        elif opt in ('-f', '--files'):
+            files = value.split(',')
+        elif opt in ('-P', '--pid'):
+            pid = int(value)
+        elif opt in ('-h', '--help'):
+            print __doc__
+            sys.exit()
+
+    if not args:
+        print __doc__
+        sys.exit(1)
+
+    app = args[0]
+    keys = [hmesim.key_number(name) for name in args[1:]]
+
+    print ('%7s %8s %9s %9s %9s %10s %8s %6s %9s' %
+           ('clients', 'sessions', 'sess/sec', 'p50 ms', 'p99 ms',
+            'cmds/sec', 'fetches', 'errors', 'rss KB'))
+    for count in levels:
+        result = run_level(count, host, port, app, keys, rounds, interval,
+                           linger, files)
+        rss = pid and server_rss(pid) or ''
+        print ('%7d %8d %9.2f %9.2f %9.2f %10.1f %8d %6d %9s' %
+               (count, result['sessions'], result['sessions_per_sec'],
+                result['latency_p50'] * 1000, result['latency_p99'] * 1000,
+                result['commands_per_sec'], result['fetches'],
+                result['errors'], rss))
@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+
+# HME Session Recorder for Python, v0.20
+# Copyright 2012 William McBrine
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You didn't receive a copy of the license with this library because
+# you already have dozens of copies, don't you? If not, visit gnu.org.
+
+""" HME Session Recorder for Python
+
+    Records the traffic of an HME session -- the handshake, each event
+    from the receiver, and each command to it -- to a compact binary
+    file, with timestamps; and replays the recorded events to an app
+    class, reporting what the app sent back and how long it took.
+
+    To record sessions from start.py, set "record" in the [hmeserver]
+    section of config.ini to a directory; each session is then saved
+    there as <app>-<time>.hmr. To replay one:
+
+    ./hmerecord.py [-s speed] file.hmr [module]
+
+    The module defaults to the app name that was recorded. A speed of
+    2 replays twice as fast as the original; 0 replays with no delays
+    at all. As with start.py, the app's section of config.ini (if any)
+    becomes its context.appdata.
+
+    File format: the magic string 'HMER' and a version byte, followed
+    by records, each with a header of kind (byte), time since the
+    start of the session (double) and length (unsigned int), all in
+    network order, and then the data. Events and commands are stored
+    whole, without the chunk framing.
+
+"""
+
+__author__ = 'William McBrine <wmcbrine@gmail.com>'
+__version__ = '0.20'
+__license__ = 'LGPL'
+
+import getopt
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from ConfigParser import SafeConfigParser
+from cStringIO import StringIO
+
+import hme
+
+MAGIC = 'HMER\x01'
+
+# Record kinds
+
+REC_INFO = 0
+REC_HANDSHAKE_IN = 1
+REC_HANDSHAKE_OUT = 2
+REC_EVENT = 3
+REC_COMMAND = 4
+
+_HEADER = struct.Struct('!BdI')
+
+class _Deframer:
+    """ Split a byte stream into the 8-byte HME handshake, followed by
+        chunked messages, and pass each one to emit(kind, data).
+
+    """
+    def __init__(self, emit, kind, hs_kind):
+        self.emit = emit
+        self.kind = kind
+        self.hs_kind = hs_kind
+        self.handshake = True
+        self.data = ''
+        self.chunks = []
+
+    def feed(self, data):
+        self.data += data
+        while True:
+            if self.handshake:
+                if len(self.data) < 8:
+                    return
+                self.emit(self.hs_kind, self.data[:8])
+                self.data = self.data[8:]
+                self.handshake = False
+            if len(self.data) < 2:
+                return
+            length = struct.unpack('!H', self.data[:2])[0]
+            if len(self.data) < 2 + length:
+                return
+            if length:
+                self.chunks.append(self.data[2:2 + length])
+            else:
+                self.emit(self.kind, ''.join(self.chunks))
+                self.chunks = []
+            self.data = self.data[2 + length:]
+
+class _RecordingFile:
+    """ Wrap a file object, passing the data read from or written to it
+        through a _Deframer.
+
+    """
+    def __init__(self, stream, deframer):
+        self.stream = stream
+        self.deframer = deframer
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.deframer.feed(data)
+        return data
+
+    def write(self, data):
+        self.stream.write(data)
+        self.deframer.feed(data)
+
+    def __getattr__(self, name):
+        # Keep private attributes (and the file descriptor) hidden, so
+        # that hme._EventReader doesn't bypass this and read the socket
+        # directly.
+        if name.startswith('_') or name == 'fileno':
+            raise AttributeError(name)
+        return getattr(self.stream, name)
+
+class _RecordingInput(_RecordingFile):
+    """ A _RecordingFile for a socket file object, or a stream with a 
+        file descriptor, that also offers recv_into() and ready(), so 
+        that hme._EventReader can still read it in batches, the same as
+        when the session isn't being recorded.
+
+    """
+    def __init__(self, stream, deframer):
+        _RecordingFile.__init__(self, stream, deframer)
+        self.sock = getattr(stream, '_sock', None)
+        self.rbuf = getattr(stream, '_rbuf', None)
+        if not hasattr(self.sock, 'recv_into') or self.rbuf is None:
+            self.sock = self.rbuf = None
+            self.fd = stream.fileno()
+
+    def _pending(self):
+        """ Take whatever the socket file object has buffered. """
+        if self.rbuf is None or not self.rbuf.tell():
+            return ''
+        data = self.rbuf.getvalue()
+        self.rbuf.seek(0)
+        self.rbuf.truncate()
+        return data
+
+    def recv_into(self, buffer):
+        data = self._pending()
+        if len(data) > len(buffer):
+            self.rbuf.write(data[len(buffer):])
+            data = data[:len(buffer)]
+        if data:
+            count = len(data)
+            buffer[:count] = data
+        elif self.sock:
+            count = self.sock.recv_into(buffer)
+            data = buffer[:count].tobytes()
+        else:
+            data = os.read(self.fd, len(buffer))
+            count = len(data)
+            buffer[:count] = data
+        self.deframer.feed(data)
+        return count
+
+    def ready(self):
+        if self.rbuf is not None and self.rbuf.tell():
+            return True
+        try:
+            return bool(select.select([self.sock or self.fd], [], [], 0)[0])
+        except (EnvironmentError, select.error, ValueError):
+            return True
+
+def _recording_input(stream, deframer):
+    """ Wrap an input stream in a _RecordingInput if it can be read in 
+        batches, or a plain _RecordingFile otherwise.
+
+    """
+    sock = getattr(stream, '_sock', None)
+    if hasattr(sock, 'recv_into') and getattr(stream, '_rbuf', None):
+        return _RecordingInput(stream, deframer)
+    try:
+        stream.fileno()
+    except (AttributeError, EnvironmentError, ValueError):
+        return _RecordingFile(stream, deframer)
+    return _RecordingInput(stream, deframer)
+
+class Recorder:
+    """ Record an HME session to the file named by path. rfile and
+        wfile are the session's input and output streams; use the
+        Recorder's rfile and wfile in their place.
+
+    """
+    def __init__(self, path, rfile, wfile, appname=''):
+        self.out = open(path, 'wb')
+        self.out.write(MAGIC)
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.rfile = _recording_input(rfile, _Deframer(self.log, REC_EVENT,
+                                                       REC_HANDSHAKE_IN))
+        self.wfile = _RecordingFile(wfile, _Deframer(self.log, REC_COMMAND,
+                                                     REC_HANDSHAKE_OUT))
+        self.log(REC_INFO, 'app=%s' % appname)
+
+    def log(self, kind, data):
+        """ Write one record. """
+        self.lock.acquire()
+        try:
+            if self.out:
+                self.out.write(_HEADER.pack(kind, time.time() - self.start,
+                                            len(data)) + data)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.out:
+                self.out.close()
+                self.out = None
+        finally:
+            self.lock.release()
+
+def read_records(path):
+    """ Return a list of (kind, time, data) tuples from a recording. """
+    f = open(path, 'rb')
+    try:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not an HME recording' % path)
+        records = []
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                break
+            kind, when, length = _HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                break
+            records.append((kind, when, data))
+        return records
+    finally:
+        f.close()
+
+def get_info(records):
+    """ Return the info record from a recording as a dict. """
+    info = {}
+    for kind, when, data in records:
+        if kind == REC_INFO:
+            for line in data.splitlines():
+                key, value = line.split('=', 1)
+                info[key] = value
+    return info
+
+class _ReplayInput:
+    """ Input stream for a replayed session -- returns the recorded
+        handshake and events, holding each event back until its time
+        comes (scaled by speed, unless that's 0).
+
+        Like a socket, it offers recv_into(), which returns everything 
+        that's due, so that hme._EventReader gets events in the same 
+        batches as it would have live. With a speed of 0, events 
+        recorded within BATCH_TIME seconds of each other are batched.
+
+    """
+    BATCH_TIME = 0.001
+
+    def __init__(self, records, speed):
+        self.records = [(kind, when, data) for kind, when, data in records
+                        if kind in (REC_HANDSHAKE_IN, REC_EVENT)]
+        self.speed = speed
+        self.index = 0
+        self.buffer = ''
+        self.start = time.time()
+        self.wait_time = 0.0
+        self.events = 0
+        self.last = 0.0   # Recorded time of the latest record returned
+
+    def _next(self):
+        kind, when, data = self.records[self.index]
+        self.index += 1
+        self.last = when
+        if self.speed:
+            delay = self.start + when / self.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+                self.wait_time += delay
+        if kind == REC_EVENT:
+            out = StringIO()
+            hme._put_chunked(out, data)
+            data = out.getvalue()
+            self.events += 1
+        self.buffer += data
+
+    def _due(self):
+        """ Check whether the next record is due yet. """
+        when = self.records[self.index][1]
+        if self.speed:
+            return self.start + when / self.speed <= time.time()
+        return when <= self.last + self.BATCH_TIME
+
+    def ready(self):
+        return (bool(self.buffer) or self.index >= len(self.records) or
+                self._due())
+
+    def recv_into(self, buffer):
+        if not self.buffer and self.index < len(self.records):
+            self._next()
+        while (self.index < len(self.records) and
+               len(self.buffer) < len(buffer) and self._due()):
+            self._next()
+        data = self.buffer[:len(buffer)]
+        self.buffer = self.buffer[len(data):]
+        buffer[:len(data)] = data
+        return len(data)
+
+    def read(self, size=-1):
+        while ((size < 0 or len(self.buffer) < size) and
+               self.index < len(self.records)):
+            self._next()
+        if size < 0:
+            size = len(self.buffer)
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+class _CountingOutput:
+    """ Output stream for a replayed session -- discards the commands,
+        but counts them.
+
+    """
+    def __init__(self):
+        self.commands = 0
+        self.bytes = 0
+        self.deframer = _Deframer(self.count, REC_COMMAND, REC_HANDSHAKE_OUT)
+
+    def count(self, kind, data):
+        if kind == REC_COMMAND:
+            self.commands += 1
+            self.bytes += len(data)
+
+    def write(self, data):
+        self.deframer.feed(data)
+
+    def flush(self):
+        pass
+
+class _ReplayContext:
+    """ Stand-in for start.py's handler, as an app's context. """
+    def __init__(self, rfile, wfile, appdata):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.appdata = appdata
+        self.headers = {}
+
+    def log_message(self, format, *args):
+        sys.stderr.write((format % args) + '\n')
+
+def replay(appclass, path, speed=1.0, appdata=None):
+    """ Run appclass against the events recorded in path, at the given
+        speed (0 for no delays), and return a dict describing what
+        happened: events fed, commands and command bytes (not counting
+        framing) written, with the recorded numbers for comparison, and
+        the time spent overall and in the app itself.
+
+    """
+    records = read_records(path)
+    rfile = _ReplayInput(records, speed)
+    wfile = _CountingOutput()
+    context = _ReplayContext(rfile, wfile, appdata or {})
+    appinst = appclass(context=context)
+    appinst.mainloop()
+    elapsed = time.time() - rfile.start
+    return {'events': rfile.events,
+            'commands': wfile.commands,
+            'bytes': wfile.bytes,
+            'recorded_commands': len([r for r in records
+                                      if r[0] == REC_COMMAND]),
+            'recorded_bytes': sum(len(r[2]) for r in records
+                                  if r[0] == REC_COMMAND),
+            'elapsed': elapsed,
+            'handler_time': elapsed - rfile.wait_time}
+
+def load_app(name):
+    """ Import the named module, and return its app class (or FACTORY,
+        if it has one), the same way start.py does.
+
+    """
+    app = __import__(name)
+    appclass = getattr(app, getattr(app, 'CLASS_NAME', name.title()))
+    return getattr(app, 'FACTORY', appclass)
+
+if __name__ == '__main__':
+    speed = 1.0
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 's:h', ['speed=', 'help'])
+    except getopt.GetoptError, msg:
+        print msg
+        sys.exit(1)
+
+    for opt, value in opts:
+        if opt in ('-s', '--speed'):
+            speed = float(value)
+        elif opt in ('-h', '--help'):
+            print __doc__
+            sys.exit()
+
+    if not args:
+        print __doc__
+        sys.exit(1)
+
+    path = args[0]
+    if len(args) > 1:
+        name = args[1]
+    else:
+        name = get_info(read_records(path)).get('app')
+
+    config = SafeConfigParser()
+    config.read('config.ini')
+    appdata = {}
+    if config.has_section(name):
+        appdata.update(dict(config.items(name)))
+
+    report = replay(load_app(name), path, speed, appdata)
+    for key in sorted(report):
+        print '%-18s %s' % (key + ':', report[key])
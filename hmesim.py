@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+
+# HME Receiver Simulator for Python, v0.20
+# Copyright 2012 William McBrine
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You didn't receive a copy of the license with this library because
+# you already have dozens of copies, don't you? If not, visit gnu.org.
+
+""" HME Receiver Simulator for Python
+
+    A headless stand-in for a TiVo, for testing and benchmarking HME
+    apps (as served by start.py) on machines with no TiVo around. It
+    connects to an app, does the handshake, sends the usual startup
+    events, and then sends whatever keys it's told to. Meanwhile, it
+    parses the command stream, keeping a shadow copy of the view tree
+    and resources; acknowledges fonts (with made-up metrics) and
+    streams; and sends back the events that apps schedule with
+    send_key(), when they come due.
+
+    Command-line usage:
+
+    ./hmesim.py [options] <app> [key] [key] ...
+
+    -a, --address     Address of the server (default 127.0.0.1).
+    -p, --port        Port of the server (default 9042).
+    -i, --interval    Seconds between keys (default 0.5).
+    -l, --linger      Seconds to wait after the last key (default 2).
+    -d, --hd          Offer high-definition resolutions.
+    -h, --help        Print help and exit.
+
+    Keys are given by name, without the "KEY_" -- e.g., "right",
+    "select", "num5". An "idle" pseudo-key sends an idle event instead.
+    A summary of what the app did is printed at the end.
+
+"""
+
+__author__ = 'William McBrine <wmcbrine@gmail.com>'
+__version__ = '0.20'
+__license__ = 'LGPL'
+
+import getopt
+import heapq
+import select
+import socket
+import sys
+import time
+from cStringIO import StringIO
+
+import hme
+
+SD_RESOLUTIONS = [(640, 480, 1, 1)]
+HD_RESOLUTIONS = [(1280, 720, 1, 1), (704, 480, 40, 33), (640, 480, 1, 1)]
+
+DEVICE_INFO = {'brand': 'TiVo', 'platform': 'sim', 'version': '20.2',
+               'host': 'hmesim'}
+
+# Parameter formats for each command, after the command and id. 'r'
+# means the rest of the data, raw.
+
+_CMD_FORMATS = {hme._CMD_VIEW_ADD: 'iiiiib',
+                hme._CMD_VIEW_SET_BOUNDS: 'iiiii',
+                hme._CMD_VIEW_SET_SCALE: 'ffi',
+                hme._CMD_VIEW_SET_TRANSLATION: 'iii',
+                hme._CMD_VIEW_SET_TRANSPARENCY: 'fi',
+                hme._CMD_VIEW_SET_VISIBLE: 'bi',
+                hme._CMD_VIEW_SET_PAINTING: 'b',
+                hme._CMD_VIEW_SET_RESOURCE: 'ii',
+                hme._CMD_VIEW_REMOVE: 'i',
+                hme._CMD_RSRC_ADD_COLOR: 'r',
+                hme._CMD_RSRC_ADD_TTF: 'r',
+                hme._CMD_RSRC_ADD_FONT: 'iifi',
+                hme._CMD_RSRC_ADD_TEXT: 'iis',
+                hme._CMD_RSRC_ADD_IMAGE: 'r',
+                hme._CMD_RSRC_ADD_SOUND: 'r',
+                hme._CMD_RSRC_ADD_STREAM: 'ssbd',
+                hme._CMD_RSRC_ADD_ANIM: 'if',
+                hme._CMD_RSRC_SET_ACTIVE: 'b',
+                hme._CMD_RSRC_SET_POSITION: 'i',
+                hme._CMD_RSRC_SET_SPEED: 'f',
+                hme._CMD_RSRC_SEND_EVENT: 'ir',
+                hme._CMD_RSRC_CLOSE: '',
+                hme._CMD_RSRC_REMOVE: '',
+                hme._CMD_RECEIVER_ACKNOWLEDGE_IDLE: 'b',
+                hme._CMD_RECEIVER_TRANSITION: 'sidv',
+                hme._CMD_RECEIVER_SET_RESOLUTION: 'iiii'}
+
+
+def _event(format, *values):
+    """ Pack an event, with HME chunking. """
+    out = StringIO()
+    hme._put_chunked(out, hme._pack(format, *values))
+    return out.getvalue()
+
+def _info_event(evnum, resource, info, format='ii', *values):
+    """ Pack an event that ends with a count and list of key/value
+        pairs (_EVT_DEVICE_INFO, _EVT_APP_INFO or _EVT_RSRC_INFO).
+
+    """
+    format += 'i' + 'ss' * len(info)
+    values = list(values) + [len(info)]
+    for key in sorted(info):
+        values.extend((key, info[key]))
+    return _event(format, evnum, resource, *values)
+
+def decode_command(data):
+    """ Split a command into (cmd, id, params). Raw data ('r') is
+        returned as a string.
+
+    """
+    ev = hme._EventData(data)
+    cmd, id = ev.unpack('ii')
+    params = []
+    for kind in _CMD_FORMATS.get(cmd, 'r'):
+        if kind == 'r':
+            params.append(data[ev.index:])
+            ev.index = len(data)
+        else:
+            params.extend(ev.unpack(kind))
+    return cmd, id, params
+
+class SimView:
+    """ Shadow copy of a View. """
+    def __init__(self, id, parent=None, xpos=0, ypos=0, width=0, height=0,
+                 visible=True):
+        self.id = id
+        self.parent = parent
+        self.children = []
+        self.bounds = (xpos, ypos, width, height)
+        self.visible = visible
+        self.painting = True
+        self.resource = hme.ID_NULL
+        self.transparency = 0
+        self.scale = (1, 1)
+        self.translation = (0, 0)
+        if parent:
+            parent.children.append(self)
+
+    def count(self):
+        """ Number of views in this subtree, including this one. """
+        return 1 + sum(child.count() for child in self.children)
+
+class Receiver:
+    """ A simulated receiver, connected to one HME app.
+
+        After connect(), the initial events are sent, and the app's
+        commands are processed by pump(), which runs for a given time,
+        or until the app quits. Keys are sent with press() (or key(),
+        for other actions), and idle events with idle(). run() puts all
+        of these together.
+
+        Along the way, the receiver collects: views, a dict of SimView
+        objects by id (root is the root view); resources, a dict of
+        (cmd, params) by id; counts of the commands received, by
+        command; the bytes received; idle_acks, a list of the handled
+        flags from acknowledgements; transitions, a list of the
+        transition commands' parameters; and latencies, the times from
+        each key sent to the first command that followed it.
+
+    """
+    def __init__(self, host='127.0.0.1', port=9042, path='/',
+                 resolutions=SD_RESOLUTIONS, device_info=DEVICE_INFO):
+        self.addr = (host, port)
+        self.path = path
+        self.resolutions = resolutions
+        self.current_resolution = resolutions[-1]
+        self.device_info = device_info
+
+        self.sock = None
+        self.reader = None
+        self.active = False
+        self.answer = ''
+
+        width, height = self.current_resolution[:2]
+        self.root = SimView(hme.ID_ROOT_VIEW, None, 0, 0, width, height,
+                            False)
+        self.views = {hme.ID_ROOT_VIEW: self.root}
+        self.resources = {}
+        self.anims = {hme.ID_NULL: 0}
+
+        self.counts = {}
+        self.commands = 0
+        self.bytes = 0
+        self.idle_acks = []
+        self.transitions = []
+        self.latencies = []
+        self.key_time = None
+        self.timers = []
+
+    def connect(self):
+        """ Request the app, do the handshake, and send the startup
+            events. Returns False if the server didn't start an app.
+
+        """
+        self.sock = socket.create_connection(self.addr)
+        self.sock.sendall('GET %s HTTP/1.1\r\nHost: %s:%d\r\n\r\n' %
+                          ((self.path,) + self.addr))
+        rfile = self.sock.makefile('rb')
+        status = rfile.readline().split()
+        while rfile.readline().strip():
+            pass
+        if len(status) < 2 or status[1] != '200':
+            self.close()
+            return False
+
+        self.answer = rfile.read(8)
+        if not self.answer.startswith('SBTV'):
+            self.close()
+            return False
+        self.sock.sendall('SBTV\0\0%c%c' % (chr(hme.HME_MAJOR_VERSION),
+                                            chr(hme.HME_MINOR_VERSION)))
+        self.reader = hme._EventReader(rfile)
+        self.active = True
+
+        self.send(_info_event(hme._EVT_DEVICE_INFO, hme.ID_ROOT_STREAM,
+                              self.device_info))
+        self.send(self.resolution_event())
+        self.send(_info_event(hme._EVT_APP_INFO, hme.ID_ROOT_STREAM,
+                              {'active': 'true'}))
+        return True
+
+    def resolution_event(self):
+        values = list(self.current_resolution) + [len(self.resolutions)]
+        for resolution in self.resolutions:
+            values.extend(resolution)
+        format = 'iiiiiiii' + 'iiii' * len(self.resolutions)
+        return _event(format, hme._EVT_RESOLUTION_INFO, hme.ID_ROOT_STREAM,
+                      4, *values)
+
+    def send(self, data):
+        if self.active:
+            try:
+                self.sock.sendall(data)
+            except socket.error:
+                self.close()
+
+    def key(self, keynum, action=hme.KEY_PRESS, rawcode=0):
+        """ Send a key event. """
+        self.key_time = time.time()
+        self.send(_event('iiiii', hme._EVT_KEY, hme.ID_ROOT_STREAM, action,
+                         keynum, rawcode))
+
+    def press(self, keynum, rawcode=0):
+        """ Press and release a key. """
+        self.key(keynum, hme.KEY_PRESS, rawcode)
+        self.key(keynum, hme.KEY_RELEASE, rawcode)
+
+    def idle(self, idle=True):
+        """ Send an idle event; the acknowledgement is added to
+            idle_acks.
+
+        """
+        self.send(_event('iib', hme._EVT_IDLE, hme.ID_ROOT_STREAM, idle))
+
+    def close(self):
+        self.active = False
+        if self.sock:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+
+    def pump(self, duration):
+        """ Process commands, and send scheduled events, for duration
+            seconds, or until the app quits. Returns self.active.
+
+        """
+        deadline = time.time() + duration
+        while self.active:
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                self.send(heapq.heappop(self.timers)[2])
+            timeout = deadline - now
+            if timeout <= 0:
+                break
+            if self.timers:
+                timeout = min(timeout, self.timers[0][0] - now)
+            try:
+                readable = select.select([self.sock], [], [], timeout)[0]
+            except (select.error, socket.error):
+                self.close()
+                break
+            if readable:
+                events = self.reader.read_events(False)
+                if self.reader.eof:
+                    self.close()
+                for data in events:
+                    self.handle_command(data)
+        return self.active
+
+    def run(self, keys=(), interval=0.5, linger=2.0):
+        """ Connect, send each key (by number, or 'idle') at the given
+            interval, and then wait up to linger seconds for the app to
+            finish. Returns True if the app was still running at the
+            end.
+
+        """
+        if not self.connect():
+            return False
+        self.pump(interval)
+        for keynum in keys:
+            if not self.active:
+                break
+            if keynum == 'idle':
+                self.idle()
+            else:
+                self.press(keynum)
+            self.pump(interval)
+        self.pump(linger)
+        still_active = self.active
+        self.close()
+        return still_active
+
+    def handle_command(self, data):
+        """ Update the shadow state for one command, and respond to it
+            if needed.
+
+        """
+        if self.key_time is not None:
+            self.latencies.append(time.time() - self.key_time)
+            self.key_time = None
+        self.commands += 1
+        self.bytes += len(data)
+        cmd, id, params = decode_command(data)
+        self.counts[cmd] = self.counts.get(cmd, 0) + 1
+
+        if cmd == hme._CMD_VIEW_ADD:
+            parent = self.views.get(params[0])
+            self.views[id] = SimView(id, parent, *params[1:])
+            return
+
+        view = self.views.get(id)
+        if cmd <= hme._CMD_VIEW_REMOVE and not view:
+            return
+        if cmd == hme._CMD_VIEW_SET_BOUNDS:
+            view.bounds = tuple(params[:4])
+        elif cmd == hme._CMD_VIEW_SET_SCALE:
+            view.scale = tuple(params[:2])
+        elif cmd == hme._CMD_VIEW_SET_TRANSLATION:
+            view.translation = tuple(params[:2])
+        elif cmd == hme._CMD_VIEW_SET_TRANSPARENCY:
+            view.transparency = params[0]
+        elif cmd == hme._CMD_VIEW_SET_VISIBLE:
+            view.visible = params[0]
+        elif cmd == hme._CMD_VIEW_SET_PAINTING:
+            view.painting = params[0]
+        elif cmd == hme._CMD_VIEW_SET_RESOURCE:
+            view.resource = params[0]
+        elif cmd == hme._CMD_VIEW_REMOVE:
+            self.remove_view(view)
+
+        elif hme._CMD_RSRC_ADD_COLOR <= cmd <= hme._CMD_RSRC_ADD_ANIM:
+            if params and type(params[-1]) == str:
+                params[-1] = len(params[-1])  # Don't keep image data
+            self.resources[id] = (cmd, params)
+            if cmd == hme._CMD_RSRC_ADD_ANIM:
+                self.anims[id] = params[0] / 1000.0
+            elif cmd == hme._CMD_RSRC_ADD_FONT and params[3]:
+                self.send(self.font_event(id, params[2], params[3]))
+            elif cmd == hme._CMD_RSRC_ADD_STREAM and params[2]:
+                self.send(_info_event(hme._EVT_RSRC_INFO, id, {'speed': '1'},
+                                      'iii', hme.RSRC_STATUS_PLAYING))
+        elif cmd == hme._CMD_RSRC_REMOVE:
+            self.resources.pop(id, None)
+            self.anims.pop(id, None)
+        elif cmd == hme._CMD_RSRC_SEND_EVENT:
+            due = time.time() + self.anims.get(params[0], 0)
+            out = StringIO()
+            hme._put_chunked(out, params[1])
+            heapq.heappush(self.timers, (due, self.commands, out.getvalue()))
+
+        elif cmd == hme._CMD_RSRC_SET_ACTIVE:
+            if id == hme.ID_ROOT_STREAM and not params[0]:
+                self.close()  # The app is done
+        elif cmd == hme._CMD_RECEIVER_ACKNOWLEDGE_IDLE:
+            self.idle_acks.append(params[0])
+        elif cmd == hme._CMD_RECEIVER_TRANSITION:
+            self.transitions.append(params)
+        elif cmd == hme._CMD_RECEIVER_SET_RESOLUTION:
+            self.current_resolution = tuple(params)
+            self.root.bounds = (0, 0) + tuple(params[:2])
+
+    def remove_view(self, view):
+        if view.parent:
+            view.parent.children.remove(view)
+        stack = [view]
+        while stack:
+            view = stack.pop()
+            self.views.pop(view.id, None)
+            stack.extend(view.children)
+
+    def font_event(self, id, size, flags):
+        """ Make up an _EVT_FONT_INFO for a font of the given size. """
+        glyphs = []
+        if flags & hme.FONT_METRICS_GLYPH:
+            glyphs = range(32, 127)
+        ascent = size * 0.8
+        descent = size * 0.2
+        values = [hme._EVT_FONT_INFO, id, ascent, descent, size * 1.2,
+                  size * 0.2, 3, len(glyphs)]
+        for glyph in glyphs:
+            values.extend((glyph, size * 0.5, size * 0.5))
+        return _event('iiffffii' + 'iff' * len(glyphs), *values)
+
+    def summary(self):
+        """ Return a dict describing the session so far. """
+        latencies = sorted(self.latencies)
+        result = {'commands': self.commands,
+                  'bytes': self.bytes,
+                  'views': self.root.count(),
+                  'resources': len(self.resources),
+                  'idle_acks': self.idle_acks,
+                  'transitions': len(self.transitions),
+                  'resolution': self.current_resolution,
+                  'by_command': dict((hme._CMD_NAMES.get(cmd, cmd), count)
+                                     for cmd, count in self.counts.items())}
+        if latencies:
+            result['latency_max'] = latencies[-1]
+            result['latency_median'] = latencies[len(latencies) / 2]
+        return result
+
+def key_number(name):
+    """ Convert a key name ('right', 'num5', 'idle') or number. """
+    if name == 'idle':
+        return name
+    if name.isdigit():
+        return int(name)
+    return getattr(hme, 'KEY_' + name.upper())
+
+if __name__ == '__main__':
+    host = '127.0.0.1'
+    port = 9042
+    interval = 0.5
+    linger = 2.0
+    resolutions = SD_RESOLUTIONS
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'a:p:i:l:dh',
+                                   ['address=', 'port=', 'interval=',
+                                    'linger=', 'hd', 'help'])
+    except getopt.GetoptError, msg:
+        print msg
+        sys.exit(1)
+
+    for opt, value in opts:
+        if opt in ('-a', '--address'):
+            host = value
+        elif opt in ('-p', '--port'):
+            port = int(value)
+        elif opt in ('-i', '--interval'):
+            interval = float(value)
+        elif opt in ('-l', '--linger'):
+            linger = float(value)
+        elif opt in ('-d', '--hd'):
+            resolutions = HD_RESOLUTIONS
+        elif opt in ('-h', '--help'):
+            print __doc__
+            sys.exit()
+
+    if not args:
+        print __doc__
+        sys.exit(1)
+
+    receiver = Receiver(host, port, '/%s/' % args[0], resolutions)
+    receiver.run([key_number(name) for name in args[1:]], interval, linger)
+    summary = receiver.summary()
+    for key in sorted(summary):
+        print '%-16s %s' % (key + ':', summary[key])
@@ -29,6 +29,10 @@ delay = 5
 """
 
 class Picture(hme.Application):
+    # Re-encoding is slow, so skip ahead past held-down keys, rather
+    # than showing every picture in between.
+    coalesce_repeats = True
+
     def handle_resolution(self):
         """ Choose the 'optimal' resolution. """
         return self.resolutions[0]
@@ -89,10 +93,10 @@ class Picture(hme.Application):
                 self.exit_slideshow()
             if code == hme.KEY_FORWARD:
                 self.sound('right')
-                self.newpic(1)
+                self.newpic(self.repeat_count)
             elif code == hme.KEY_REVERSE:
                 self.sound('left')
-                self.newpic(-1)
+                self.newpic(-self.repeat_count)
 
     def handle_idle(self, idle):
         if idle:
@@ -26,7 +26,9 @@
     run on port 80.
 
     Each module is checked for a TITLE and CLASS_NAME attribute. If
-    either is absent, the module name is used instead.
+    either is absent, the module name is used instead. A module can 
+    also define FACTORY, a function to create the app for each session
+    (called like the class, with context=), to use instead of the class.
 
     While the samples have all been done as 'module/__init__.py' for
     neatness, they could just as well be named 'module.py' in this
@@ -81,40 +83,858 @@ __author__ = 'William McBrine <wmcbrine@gmail.com>'
 __version__ = '0.20'
 __license__ = 'LGPL'
 
+import cgi
+import copy
+import email.utils
+import errno
 import getopt
+import gzip
+import hashlib
+import json
 import mimetypes
 import os
+import Queue
+import re
+import select
+import signal
 import socket
+import stat
 import sys
+import threading
 import time
+import traceback
 import urllib
+import urlparse
 import uuid
+import zlib
 import SocketServer
 import BaseHTTPServer
+from collections import deque, OrderedDict
 from ConfigParser import SafeConfigParser
+from cStringIO import StringIO
 from threading import Timer
 
 # Version of the protocol implemented
 from hme import HME_MAJOR_VERSION, HME_MINOR_VERSION
 
+import hme
+import hmerecord
+
+# sendfile() comes from the pysendfile module, if installed (it's not 
+# in the standard library for Python 2).
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = None
+
+# pyinotify, if installed, lets the path cache find out about changes 
+# as they happen, instead of checking every so often.
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
 HME_ZC = '_tivo-hme._tcp.local.'
 HME_VERSION = '%d.%d' % (HME_MAJOR_VERSION, HME_MINOR_VERSION)
 HME_MIME = 'application/x-hme'
 PLATFORM = 'HMEPython'
 
+_HEADER_END = re.compile(r'\r?\n\r?\n')
+_WOULDBLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+_NOSENDFILE = (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP)
+_NORESOURCES = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+SENDFILE_SIZE = 0x100000   # Most to ask sendfile() for at once
+
 def norm(path): 
     return os.path.normcase(os.path.abspath(os.path.normpath(path)))
 
+def parse_range(value, size):
+    """ Parse the value of a Range header, for a file of the given 
+        size. Returns the (first, last) byte positions of the range, or
+        None if the header should be ignored and the whole file sent --
+        if it's malformed, or asks for more than one range. Raises 
+        ValueError if the range can't be satisfied.
+
+    """
+    value = value.strip()
+    if not value.startswith('bytes=') or ',' in value or '-' not in value:
+        return None
+    first, last = [x.strip() for x in value[6:].split('-', 1)]
+    if not first:
+        # Suffix range -- the last n bytes
+        if not last.isdigit():
+            return None
+        if not size or not int(last):
+            raise ValueError('unsatisfiable range')
+        return max(0, size - int(last)), size - 1
+    if not first.isdigit() or (last and not last.isdigit()):
+        return None
+    first = int(first)
+    if last:
+        last = int(last)
+        if last < first:
+            return None
+    else:
+        last = size - 1
+    if first >= size:
+        raise ValueError('unsatisfiable range')
+    return first, min(last, size - 1)
+
+class Pool:
+    """ A fixed number of worker threads, handling requests for the 
+        server. Up to queue_size more requests can wait for a free 
+        worker; past that, submit() refuses them.
+
+    """
+    def __init__(self, server, name, workers, queue_size):
+        self.server = server
+        self.name = name
+        self.workers = workers
+        self.limit = workers + queue_size
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.busy = 0
+
+    def start(self):
+        for i in xrange(self.workers):
+            thread = threading.Thread(target=self.work)
+            thread.setDaemon(True)
+            thread.start()
+
+    def submit(self, request, client_address, data=''):
+        """ Queue a request, returning False if the pool is full. data 
+            is anything already read from the connection.
+
+        """
+        self.lock.acquire()
+        try:
+            if self.pending >= self.limit:
+                return False
+            self.pending += 1
+        finally:
+            self.lock.release()
+        self.queue.put((request, client_address, data))
+        return True
+
+    def work(self):
+        while True:
+            request, client_address, data = self.queue.get()
+            self.lock.acquire()
+            self.busy += 1
+            self.lock.release()
+            try:
+                self.server.process_request_thread(request, client_address,
+                                                   data)
+            finally:
+                self.lock.acquire()
+                self.busy -= 1
+                self.pending -= 1
+                self.lock.release()
+
+    def get_stats(self):
+        return {'workers': self.workers, 'busy': self.busy,
+                'queued': self.pending - self.busy,
+                'limit': self.limit}
+
+def socket_pair():
+    """ Return a pair of connected sockets -- from socketpair() where 
+        it exists, or over the loopback interface where it doesn't.
+
+    """
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    first = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    first.connect(listener.getsockname())
+    second = listener.accept()[0]
+    listener.close()
+    return first, second
+
+class Dispatcher:
+    """ Waits, in a thread of its own, for new connections to send 
+        their request lines, and hands each one to the HME or file pool
+        when it does. Connections that send nothing within the timeout 
+        are closed. This keeps the accept loop from ever waiting on a 
+        client.
+
+    """
+    def __init__(self, server):
+        self.server = server
+        self.lock = threading.Lock()
+        self.incoming = []
+        self.waiting = {}   # fd -> (request, client_address, deadline)
+        self.wake_in, self.wake_out = socket_pair()
+        self.wake_out.setblocking(0)
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def add(self, request, client_address, timeout):
+        """ Wait up to timeout seconds for the connection's request. """
+        self.lock.acquire()
+        self.incoming.append((request, client_address,
+                              time.time() + timeout))
+        self.lock.release()
+        try:
+            self.wake_out.send('x')
+        except socket.error:
+            pass    # The loop's already due to wake up
+
+    def run(self):
+        poller = _Poller()
+        wake = self.wake_in.fileno()
+        poller.register(wake, _Poller.READ)
+        while True:
+            timeout = 1.0
+            if self.waiting:
+                first = min(entry[2] for entry in self.waiting.values())
+                timeout = max(min(first - time.time(), timeout), 0)
+            try:
+                events = poller.poll(timeout)
+            except (select.error, IOError), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, flags in events:
+                if fd == wake:
+                    self.wake_in.recv(1024)
+                    self.lock.acquire()
+                    incoming, self.incoming = self.incoming, []
+                    self.lock.release()
+                    for entry in incoming:
+                        fd = entry[0].fileno()
+                        self.waiting[fd] = entry
+                        poller.register(fd, _Poller.READ)
+                    continue
+                entry = self.waiting.pop(fd, None)
+                if entry:
+                    poller.unregister(fd)
+                    self.ready(*entry[:2])
+            now = time.time()
+            for fd, (request, client_address,
+                     deadline) in self.waiting.items():
+                if deadline <= now:
+                    del self.waiting[fd]
+                    poller.unregister(fd)
+                    self.server.shutdown_request(request)
+
+    def ready(self, request, client_address):
+        """ Peek at the data that's come in, without consuming it, and 
+            pass the connection on -- or close it, if the client has.
+
+        """
+        try:
+            line = request.recv(1024, socket.MSG_PEEK)
+        except socket.error:
+            line = ''
+        if not line:
+            self.server.shutdown_request(request)
+            return
+        request.setblocking(1)
+        self.server.dispatch(request, client_address, line)
+
+class LRUCache:
+    """ A memory-bounded cache, which drops the least recently used 
+        entries first. Entries are strings, unless a subclass says how 
+        to size them, with sizeof().
+
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()   # Least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def sizeof(self, value):
+        return len(value)
+
+    def get(self, key):
+        """ Return the entry for a key, or None. """
+        self.lock.acquire()
+        try:
+            value = self.entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+            else:
+                self.entries[key] = value
+                self.hits += 1
+            return value
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = value
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(iter(self.entries).next())
+        finally:
+            self.lock.release()
+
+    def _remove(self, key):
+        self.bytes -= self.sizeof(self.entries.pop(key))
+
+class _CachedFile:
+    """ A file in a FileCache, as ready-made responses to a GET for it 
+        -- the headers and body as one string, less the status line and
+        the Server and Date headers. There's one for each coding (None 
+        for the file as is).
+
+    """
+    def __init__(self, path, mtime, size, mime, validators, data,
+                 codings=()):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.compressible = bool(codings)
+        self.responses = {}
+        self._add(None, [('Content-Type', mime), ('Content-Length', str(size)),
+                         ('Accept-Ranges', 'bytes')], validators, data)
+        for coding in codings:
+            body = compress_data(data, coding)
+            self._add(coding, [('Content-Type', mime),
+                               ('Content-Length', str(len(body))),
+                               ('Content-Encoding', coding)],
+                      [('ETag', variant_etag(validators[0][1], coding))] +
+                      validators[1:], body)
+        self.bytes = sum(len(response[2])
+                         for response in self.responses.values())
+        self.checked = time.time()
+
+    def _add(self, coding, headers, validators, data):
+        text = ''.join('%s: %s\r\n' % header
+                       for header in headers + validators) + '\r\n'
+        self.responses[coding] = (validators[0][1], validators, text + data,
+                                  len(text))
+
+class FileCache(LRUCache):
+    """ A cache of small files, each kept as ready-made responses, so 
+        that requests for icons and the like can be answered without 
+        touching the filesystem. An entry is checked against the file's
+        mtime and size when it's used, but not more often than every 
+        interval seconds.
+
+    """
+    def __init__(self, max_bytes, max_file, interval):
+        LRUCache.__init__(self, max_bytes)
+        self.max_file = max_file
+        self.interval = interval
+
+    def sizeof(self, entry):
+        return entry.bytes
+
+    def get(self, key):
+        """ Return the entry for a URL path, or None. """
+        entry = LRUCache.get(self, key)
+        if not entry:
+            return None
+
+        now = time.time()
+        if now - entry.checked >= self.interval:
+            try:
+                stat = os.stat(entry.path)
+            except OSError:
+                stat = None
+            if (not stat or int(stat.st_mtime) != entry.mtime or
+                stat.st_size != entry.size):
+                self.lock.acquire()
+                if self.entries.get(key) is entry:
+                    self._remove(key)
+                self.hits -= 1
+                self.misses += 1
+                self.lock.release()
+                return None
+            entry.checked = now
+        return entry
+
+# Types of files worth compressing, besides text/*. (Images, video and 
+# so on are compressed already.)
+COMPRESSIBLE = ('application/json', 'application/xml',
+                'application/javascript', 'application/x-javascript',
+                'application/xhtml+xml', 'image/svg+xml')
+
+def compressible(mime):
+    mime = mime.split(';')[0].strip()
+    return mime.startswith('text/') or mime in COMPRESSIBLE
+
+def pick_coding(accept_encoding):
+    """ Choose gzip or deflate (preferring gzip), as allowed by an 
+        Accept-Encoding header; or None.
+
+    """
+    qualities = {}
+    for item in accept_encoding.split(','):
+        params = item.strip().lower().split(';')
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        qualities[params[0].strip()] = quality
+    for coding in ('gzip', 'deflate'):
+        if qualities.get(coding, qualities.get('*', 0)) > 0:
+            return coding
+    return None
+
+def compress_data(data, coding):
+    """ Return data compressed with 'gzip' or 'deflate'. """
+    if coding == 'deflate':
+        return zlib.compress(data)
+    return gzip_data(data)
+
+def variant_etag(etag, coding):
+    """ Return the ETag for a compressed copy. """
+    return '%s-%s"' % (etag[:-1], coding)
+
+def gzip_data(data):
+    """ Return data gzip-compressed. """
+    out = StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb', mtime=0)
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+class _Listing:
+    """ A rendered TiVoConnect listing, with its ETag, and compressed 
+        copies, made as they're asked for.
+
+    """
+    def __init__(self, data):
+        self.data = data
+        self.etag = '"%s"' % hashlib.md5(data).hexdigest()
+        self.compressed = {}
+
+    def get(self, coding=None):
+        """ Return the body and ETag, as is or compressed. """
+        if not coding:
+            return self.data, self.etag
+        if coding not in self.compressed:
+            self.compressed[coding] = compress_data(self.data, coding)
+        return self.compressed[coding], variant_etag(self.etag, coding)
+
+class ListingCache:
+    """ TiVoConnect listings, rendered once for each variant (with or 
+        without genres, and each page). They only change with the set 
+        of apps, which is fixed at startup, so they're never cleared 
+        (except to keep the number of them down).
+
+    """
+    MAX_ENTRIES = 100
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            listing = self.entries.get(key)
+            if listing:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return listing
+        finally:
+            self.lock.release()
+
+    def put(self, key, listing):
+        self.lock.acquire()
+        if len(self.entries) >= self.MAX_ENTRIES:
+            self.entries.clear()
+        self.entries[key] = listing
+        self.lock.release()
+
+class _Resolved:
+    """ Where a URL path for a static file leads: the file, with its 
+        extension and MIME type, or the error to send instead (403 or 
+        404). stat is what os.stat() returned for the path (None if the
+        file wasn't there), or False if it didn't need looking up -- 
+        when the path is refused on its face. The mtime from it tells 
+        when the entry is out of date.
+
+    """
+    def __init__(self, path, error=None, ext='', mime=None, stat=False):
+        self.path = path
+        self.error = error
+        self.ext = ext
+        self.mime = mime
+        self.looked_up = stat is not False
+        self.mtime = stat and stat.st_mtime
+        self.checked = time.time()
+
+    def changed(self):
+        if not self.looked_up:
+            return False
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        return mtime != self.mtime
+
+class PathCache:
+    """ URL paths for static files, resolved to files on disk, so that 
+        the unquoting, normalizing and checks needn't be redone for each
+        request. An entry is checked against the file's mtime when it's
+        used, but not more often than every interval seconds -- unless 
+        there's a watcher, which drops entries as the files change.
+
+    """
+    def __init__(self, max_entries, interval):
+        self.max_entries = max_entries
+        self.interval = interval
+        self.entries = OrderedDict()   # Least recently used first
+        self.watched = False
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Return the _Resolved for a URL path, or None. """
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry and not self.watched:
+                now = time.time()
+                if now - entry.checked >= self.interval:
+                    if entry.changed():
+                        entry = None
+                    else:
+                        entry.checked = now
+            if entry:
+                self.entries[key] = entry
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry
+        finally:
+            self.lock.release()
+
+    def put(self, key, entry):
+        self.lock.acquire()
+        self.entries[key] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.lock.release()
+
+    def discard(self, path):
+        """ Drop the entries for a file, or for anything under a 
+            directory.
+
+        """
+        prefix = path + os.sep
+        self.lock.acquire()
+        for key, entry in self.entries.items():
+            if entry.path == path or entry.path.startswith(prefix):
+                del self.entries[key]
+        self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        self.entries.clear()
+        self.lock.release()
+
 class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
-    def __init__(self, addr, handler, basepath, datapath, apps, config):
+    PEEK_TIMEOUT = 5  # Seconds to wait for a request line, in pool mode
+
+    def __init__(self, addr, handler, basepath, datapath, apps, config,
+                 reuse_port=False):
         self.basepath = basepath
+        self.reuse_port = reuse_port
         self.datapath = datapath
         self.apps = apps
         self.config = config
+        self.record = self.option('record')
+        if self.record:
+            self.record = norm(self.record)
+        self.trace = self.option('trace')
+        if self.trace:
+            self.trace = norm(self.trace)
+        self.trace_spans = self.option('tracespans', hme.Tracer.MAX_SPANS)
+        self.pools = self.make_pools()
+        self.dispatcher = None
+        self.zeroconf = None   # A ZCBroadcast, set by the caller
+        self.use_sendfile = bool(sendfile) and self.option('sendfile', True)
+        self.keep_alive = self.option('keepalive', 15.0)
+        self.cache_control = dict(handler.CACHE_CONTROL)
+        if config.has_section('cachecontrol'):
+            self.cache_control.update(config.items('cachecontrol'))
+
+        # Bookkeeping for the stats server
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.sessions = {}
+        self.caches = {}
+
+        self.compress = self.option('compress', True)
+        self.compress_max = self.option('compressmax', 0x100000)
+        self.compressed = LRUCache(self.option('compresscache', 0x400000))
+        self.caches['compressed'] = self.compressed
+        self.listings = ListingCache()
+        self.caches['listing'] = self.listings
+
+        self.file_cache = None
+        cache_size = self.option('filecache', 0x400000)
+        if cache_size:
+            self.file_cache = FileCache(cache_size,
+                                        self.option('filecachemax', 0x10000),
+                                        self.option('filecachecheck', 2.0))
+            self.caches['files'] = self.file_cache
+
+        self.paths = None
+        self.notifier = None
+        path_entries = self.option('pathcache', 1000)
+        if path_entries:
+            self.paths = PathCache(path_entries,
+                                   self.option('filecachecheck', 2.0))
+            self.caches['paths'] = self.paths
+
         BaseHTTPServer.HTTPServer.__init__(self, addr, handler)
 
+    def server_bind(self):
+        """ Set SO_REUSEPORT before binding, if asked to, so that 
+            several processes can each have their own listening socket 
+            on the same port.
+
+        """
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        BaseHTTPServer.HTTPServer.server_bind(self)
+
+    def serve_forever(self, poll_interval=0.5):
+        # The pool threads are started here, rather than in __init__, 
+        # so that a Prefork can create the server before forking.
+        for pool in self.pools.values():
+            pool.start()
+        if self.pools:
+            self.dispatcher = Dispatcher(self)
+            self.dispatcher.start()
+        self.start_watcher()
+        BaseHTTPServer.HTTPServer.serve_forever(self, poll_interval)
+
+    def server_close(self):
+        if self.notifier:
+            self.notifier.stop()
+            self.notifier = None
+        BaseHTTPServer.HTTPServer.server_close(self)
+
+    def start_watcher(self):
+        """ Watch the basepath and datapath with inotify, if pyinotify 
+            is available and "inotify" is on, to keep the path cache up
+            to date. This is off by default, since every directory under
+            them needs a watch, and the datapath may be a whole drive.
+
+        """
+        if not (self.paths and pyinotify and self.option('inotify', False)):
+            return
+        paths = self.paths
+
+        class Watcher(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                paths.discard(event.pathname)
+
+        manager = pyinotify.WatchManager()
+        mask = (pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_CLOSE_WRITE | pyinotify.IN_ATTRIB |
+                pyinotify.IN_DELETE_SELF | pyinotify.IN_MOVE_SELF)
+        self.notifier = pyinotify.ThreadedNotifier(manager, Watcher())
+        self.notifier.setDaemon(True)
+        self.notifier.start()
+        for path in set([self.basepath, self.datapath]):
+            if path:
+                manager.add_watch(path, mask, rec=True, auto_add=True)
+        paths.clear()
+        paths.watched = True
+
+    def make_pools(self):
+        """ Create the worker pools, if "pool" is on. """
+        if not self.option('pool', False):
+            return {}
+        return {'hme': Pool(self, 'hme', self.option('hmethreads', 10),
+                            self.option('hmequeue', 0)),
+                'file': Pool(self, 'file', self.option('filethreads', 10),
+                             self.option('filequeue', 50))}
+
+    def option(self, name, default=None):
+        """ Get an option from the [hmeserver] section of the config, 
+            or the default if it's not there.
+
+        """
+        if self.config.has_option('hmeserver', name):
+            value = self.config.get('hmeserver', name)
+            if type(default) == bool:
+                value = self.config.getboolean('hmeserver', name)
+            elif type(default) in (int, float):
+                value = type(default)(value)
+            return value
+        return default
+
+    def process_request(self, request, client_address):
+        """ In pool mode, pass the connection to the dispatcher, to wait
+            for its request line; otherwise, start a new thread for it, 
+            as usual.
+
+        """
+        if not self.pools:
+            SocketServer.ThreadingMixIn.process_request(self, request,
+                                                        client_address)
+            return
+        request.setblocking(0)
+        self.dispatcher.add(request, client_address, self.PEEK_TIMEOUT)
+
+    def process_request_thread(self, request, client_address, data=''):
+        """ In pool mode, a connection that's kept open between requests
+            goes back to the dispatcher to wait for the next one, 
+            instead of tying up a worker while it's idle -- or if the 
+            next one has already been read, and belongs in the other 
+            pool, straight to that pool.
+
+        """
+        if not self.pools:
+            SocketServer.ThreadingMixIn.process_request_thread(
+                self, request, client_address)
+            return
+        try:
+            handler = self.RequestHandlerClass(request, client_address,
+                                               self, data)
+        except:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+        if handler.handoff:
+            self.dispatch(request, client_address, handler.handoff,
+                          handler.handoff)
+        elif handler.parked:
+            request.setblocking(0)
+            self.dispatcher.add(request, client_address, self.keep_alive)
+        else:
+            self.shutdown_request(request)
+
+    def dispatch(self, request, client_address, line, data=''):
+        """ Hand a request to the HME or file pool, according to its 
+            request line, or reject it if that pool is full. data is 
+            anything already read from the connection.
+
+        """
+        pool = self.pools[self.classify(line)]
+        if not pool.submit(request, client_address, data):
+            self.count('rejected.' + pool.name)
+            self.reject(request, data)
+
+    def classify(self, line):
+        """ Look at the request line to see whether the request is for 
+            an HME app ('hme') or anything else ('file').
+
+        """
+        words = line.split(None, 2)
+        if len(words) > 1 and words[1].split('?')[0].strip('/') in self.apps:
+            return 'hme'
+        return 'file'
+
+    def reject(self, request, data=''):
+        """ Send a 503 response to a request that there's no room for, 
+            and close it. Unless it's already been read (into data), the
+            request is read first.
+
+        """
+        body = 'Server busy, try again later.\n'
+        try:
+            # The request has already arrived, so this won't wait long.
+            request.settimeout(self.PEEK_TIMEOUT)
+            if not data:
+                request.recv(Handler.BUFSIZE)
+            request.sendall('HTTP/1.0 503 Service Unavailable\r\n'
+                            'Server: %s\r\nRetry-After: 5\r\n'
+                            'Content-Type: text/plain\r\n'
+                            'Content-Length: %d\r\n'
+                            'Connection: close\r\n\r\n%s' %
+                            (Handler.server_version, len(body), body))
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def count(self, name, amount=1):
+        """ Add to one of the server's counters. """
+        self.lock.acquire()
+        self.counts[name] = self.counts.get(name, 0) + amount
+        self.lock.release()
+
+    def add_session(self, name, client, appinst):
+        self.lock.acquire()
+        self.sessions[id(appinst)] = (name, client, appinst)
+        self.lock.release()
+
+    def remove_session(self, appinst):
+        self.lock.acquire()
+        self.sessions.pop(id(appinst), None)
+        self.lock.release()
+
+    def get_stats(self):
+        """ Return a snapshot of the server's state, as a dict. Caches 
+            (in self.caches) need to have hits and misses attributes.
+
+        """
+        self.lock.acquire()
+        counts = self.counts.copy()
+        sessions = self.sessions.values()
+        self.lock.release()
+
+        uptime = time.time() - self.started
+        by_app = {}
+        session_stats = []
+        for name, client, appinst in sessions:
+            by_app[name] = by_app.get(name, 0) + 1
+            session_stats.append({'app': name,
+                                  'client': '%s:%s' % client,
+                                  'stats': appinst.get_stats()})
+        caches = {}
+        for name, cache in self.caches.items():
+            total = cache.hits + cache.misses
+            caches[name] = {'hits': cache.hits, 'misses': cache.misses,
+                            'ratio': total and float(cache.hits) / total}
+        zeroconf_ready = zeroconf_error = None
+        if self.zeroconf:
+            zeroconf_ready = self.zeroconf.ready.isSet()
+            zeroconf_error = self.zeroconf.error
+        return {'pid': os.getpid(),
+                'uptime': uptime,
+                'zeroconf_ready': zeroconf_ready,
+                'zeroconf_error': zeroconf_error,
+                'threads': threading.activeCount(),
+                'counts': counts,
+                'rates': dict((name, value / uptime)
+                              for name, value in counts.items()),
+                'sessions_by_app': by_app,
+                'sessions': session_stats,
+                'caches': caches,
+                'pools': dict((name, pool.get_stats())
+                              for name, pool in self.pools.items())}
+
 class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
     server_version = '%s/%s' % (PLATFORM, __version__)
+    protocol_version = 'HTTP/1.1'
+
+    parked = False      # Left open for the dispatcher, in pool mode
+    handoff = ''        # A request read here, for the other pool
 
     BUFSIZE = 0x10000
 
@@ -129,11 +949,17 @@ class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     BADEXTS = ('.py', '.pyc', '.pyo')  # Don't send back the code
 
+    # Cache-Control headers for static files, by extension ('default' 
+    # for anything else). Can be changed in the [cachecontrol] section 
+    # of config.ini.
+    CACHE_CONTROL = {'.png': 'max-age=3600', '.jpg': 'max-age=3600',
+                     '.jpeg': 'max-age=3600', '.gif': 'max-age=3600'}
+
     XML_HEADER = """<?xml version="1.0" encoding="UTF-8"?><TiVoContainer>
         <Details><ContentType>x-container/tivo-server</ContentType>
         <SourceFormat>x-container/folder</SourceFormat>
         <TotalItems>%d</TotalItems><Title>HME Server for Python</Title>
-        </Details><ItemStart>0</ItemStart><ItemCount>%d</ItemCount>
+        </Details><ItemStart>%d</ItemStart><ItemCount>%d</ItemCount>
     """
 
     XML_ITEM = """<Item><Details><ContentType>%(mime)s</ContentType>
@@ -155,12 +981,62 @@ class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     XML_CLOSER = '</TiVoContainer>'
 
-    def __init__(self, request, client_address, server):
-        """ Set up a 64K output buffer before initializing. """
+    def __init__(self, request, client_address, server, data=''):
+        """ Set up a 64K output buffer before initializing. data is 
+            anything already read from the connection.
+
+        """
         self.wbufsize = 0x10000
+        self.data = data
         BaseHTTPServer.BaseHTTPRequestHandler.__init__(self, request,
             client_address, server)
 
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.rfile._rbuf.write(self.data)
+
+    def handle(self):
+        """ Handle requests until the client closes the connection, or 
+            leaves it idle for longer than the keepalive time. (With 
+            that set to 0, it's one request per connection, as in 
+            HTTP/1.0.)
+
+        """
+        idle = self.server.keep_alive
+        if not idle:
+            self.protocol_version = 'HTTP/1.0'
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection and self._wait_for_request(idle):
+            self.handle_one_request()
+
+    def _wait_for_request(self, idle):
+        """ Wait up to idle seconds for another request to start. In 
+            pool mode, only a request that's already been read, and 
+            that belongs in the same pool, is handled here. One for the
+            other pool is handed off to it, with what's been read; 
+            otherwise, the connection is parked with the dispatcher, 
+            which will pick the pool for its next request.
+
+        """
+        # A request that's already been read into the buffer counts.
+        buffered = self.rfile._rbuf.getvalue()
+        if self.server.pools:
+            if not buffered:
+                self.parked = True
+                return False
+            classify = self.server.classify
+            if classify(buffered) == classify(self.raw_requestline):
+                return True
+            self.handoff = buffered
+            return False
+        if buffered:
+            return True
+        try:
+            return bool(select.select([self.request], [], [], idle)[0])
+        except (select.error, socket.error):
+            return False
+
     def address_string(self):
         """ Override address_string() with a version that skips the 
             reverse lookup. Suggestion of Jason Michalski.
@@ -175,6 +1051,31 @@ class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
         """
         return self.server_version
 
+    def send_error(self, code, message=None):
+        """ Send an error page, as send_error() does, but with a 
+            Content-Length -- and for a 403 or 404, without closing the
+            connection.
+
+        """
+        self.server.count('errors')
+        short, explain = self.responses.get(code, ('???', '???'))
+        if message is None:
+            message = short
+        self.log_error('code %d, message %s', code, message)
+        if code not in (403, 404):
+            self.close_connection = 1
+        content = (self.error_message_format %
+                   {'code': code, 'message': cgi.escape(message),
+                    'explain': explain})
+        self.send_response(code, message)
+        self.send_header('Content-Type', self.error_content_type)
+        self.send_header('Content-Length', str(len(content)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        if self.command != 'HEAD' and code >= 200 and code not in (204, 304):
+            self.wfile.write(content)
+
     def _ok(self, mime, size=0):
         self.send_response(200)
         self.send_header('Content-Type', mime)
@@ -188,73 +1089,390 @@ class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
         apps = self.server.apps
 
         if name == 'robots.txt':
-            self._ok('text/plain')
-            self.wfile.write('User-agent: *\nDisallow: /\n')
+            self.server.count('requests.other')
+            text = 'User-agent: *\nDisallow: /\n'
+            self._ok('text/plain', len(text))
+            if body:
+                self.wfile.write(text)
 
         elif name == 'TiVoConnect':
-            if 'DoGenres=1' in self.path:
-                template = self.XML_ITEM_G
-            else:
-                template = self.XML_ITEM
+            self._listing(body)
 
-            self._ok('text/xml')
+        elif name in apps:
+            self._hme(name)
 
-            self.wfile.write(self.XML_HEADER % (len(apps), len(apps)))
-            for name in sorted(apps):
-                self.wfile.write(template % apps[name])
-            self.wfile.write(self.XML_CLOSER)
+        else:
+            self._static(path, body)
 
-        elif name in apps:
-            app = __import__(name)
-            appname = getattr(app, 'CLASS_NAME', name.title())
-            appclass = getattr(app, appname)
+    def _listing(self, body):
+        """ Send the list of apps, in TiVoConnect format, from the 
+            ListingCache if possible. ItemStart and ItemCount select a 
+            page of it; a negative count is a page ending at ItemStart.
 
-            self.appdata = apps[name]
-            self._ok(self.appdata['mime'])
+        """
+        self.server.count('requests.listing')
+        query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+        genres = 'DoGenres=1' in self.path
+        total = len(self.server.apps)
+        try:
+            start = int(query.get('ItemStart', ['0'])[0])
+            count = int(query.get('ItemCount', [str(total)])[0])
+        except ValueError:
+            start, count = 0, total
+        if count < 0:
+            start, count = start + count, -count
+        start = min(max(start, 0), total)
+        count = max(min(count, total - start), 0)
+
+        key = (genres, start, count)
+        listing = self.server.listings.get(key)
+        if not listing:
+            listing = _Listing(self.render_listing(genres, start, count))
+            self.server.listings.put(key, listing)
+
+        coding = self._coding()
+        data, etag = listing.get(coding)
+        headers = [('ETag', etag)]
+        if self.server.compress:
+            headers.append(('Vary', 'Accept-Encoding'))
+        if self._not_modified(etag, None):
+            self._send_not_modified(headers)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(data)))
+        if coding:
+            self.send_header('Content-Encoding', coding)
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
 
-            self.log_message('Starting HME: %s', name)
-            appinst = appclass(context=self)
+    def render_listing(self, genres, start, count):
+        """ Return the XML for a page of the TiVoConnect listing. """
+        apps = self.server.apps
+        if genres:
+            template = self.XML_ITEM_G
+        else:
+            template = self.XML_ITEM
+        names = sorted(apps)[start:start + count]
+        return ''.join([self.XML_HEADER % (len(apps), start, len(names))] +
+                       [template % apps[name] for name in names] +
+                       [self.XML_CLOSER])
+
+    def _coding(self):
+        """ Choose a compression method for the response, if any. """
+        if self.server.compress:
+            return pick_coding(self.headers.get('Accept-Encoding', ''))
+        return None
+
+    def _hme(self, name):
+        """ Run an HME app, for the rest of the connection. """
+        self.server.count('requests.hme')
+        # The response has no length; it just goes on until the session
+        # ends, and then so does the connection.
+        self.protocol_version = 'HTTP/1.0'
+        self.close_connection = 1
+        self.appdata = self.server.apps[name]
+        factory = self.appdata.get('factory')
+        if not factory:
+            # Not resolved at startup, so look it up now
+            app = __import__(name)
+            appname = getattr(app, 'CLASS_NAME', name.title())
+            factory = getattr(app, 'FACTORY', getattr(app, appname))
+        self._ok(self.appdata['mime'])
+
+        recorder = None
+        if self.server.record:
+            recorder = hmerecord.Recorder(os.path.join(
+                self.server.record, '%s-%d.hmr' % (name,
+                time.time() * 1000)), self.rfile, self.wfile, name)
+            self.rfile, self.wfile = recorder.rfile, recorder.wfile
+
+        self.log_message('Starting HME: %s', name)
+        appinst = None
+        try:
+            appinst = factory(context=self)
+            if self.server.trace:
+                appinst.tracer = hme.Tracer(self.server.trace_spans)
+            self.server.add_session(name, self.client_address, appinst)
             appinst.mainloop()
+        finally:
+            # Even if the app crashed, keep what was recorded and traced
             self.log_message('Ending HME: %s', name)
+            if appinst:
+                self.server.remove_session(appinst)
+                if appinst.tracer:
+                    appinst.tracer.save(os.path.join(self.server.trace,
+                        '%s-%d.json' % (name, time.time() * 1000)))
+            if recorder:
+                recorder.close()
+
+    def _static(self, path, body):
+        """ Send a file from the basepath or datapath. """
+        self.server.count('requests.static')
+        cache = None
+        if self.request_version != 'HTTP/0.9' and 'Range' not in self.headers:
+            cache = self.server.file_cache
+        if cache:
+            entry = cache.get(path)
+            if entry:
+                self._send_cached(entry, body)
+                return
+        key = path
+
+        paths = self.server.paths
+        resolved = paths and paths.get(key)
+        if not resolved:
+            resolved = self._resolve(path)
+            if paths:
+                paths.put(key, resolved)
+        if resolved.error:
+            self.send_error(resolved.error)
+            return
+        path, ext, mime = resolved.path, resolved.ext, resolved.mime
+        try:
+            page = open(path, 'rb')
+        except IOError:
+            self.send_error(404)
+            return
+        stat = os.fstat(page.fileno())
+        size = stat.st_size
+        mtime = int(stat.st_mtime)
+        etag = '"%x-%x"' % (mtime, size)
+        last_modified = self.date_time_string(mtime)
+        validators = [('ETag', etag), ('Last-Modified', last_modified)]
+        cache_control = self.server.cache_control.get(ext,
+                        self.server.cache_control.get('default'))
+        if cache_control:
+            validators.append(('Cache-Control', cache_control))
+        codings = ()
+        if self.server.compress and compressible(mime):
+            validators.append(('Vary', 'Accept-Encoding'))
+            codings = ('gzip', 'deflate')
+
+        # Compress text files, if the client allows it -- but not for 
+        # range requests, or files that are too big to do in memory.
+        coding = None
+        if (codings and 'Range' not in self.headers and
+            size <= self.server.compress_max):
+            coding = self._coding()
+        current = validators
+        if coding:
+            current = [('ETag', variant_etag(etag, coding))] + validators[1:]
+
+        if self._not_modified(current[0][1], mtime):
+            page.close()
+            self._send_not_modified(current)
+            return
+
+        # Send just part of the file, if that's what was asked for -- 
+        # e.g. when the receiver seeks or resumes in a stream. With 
+        # If-Range, only if the file hasn't changed.
+        first, last = 0, size - 1
+        range_header = self.headers.get('Range', '')
+        if_range = self.headers.get('If-Range')
+        if if_range and if_range.strip() not in (etag, last_modified):
+            range_header = ''
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            page.close()
+            self.server.count('errors')
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if cache and not byte_range and size <= cache.max_file:
+            entry = _CachedFile(path, mtime, size, mime, validators,
+                                page.read(), codings)
+            page.close()
+            cache.put(key, entry)
+            self._send_cached(entry, body)
+            return
+        if coding:
+            self._send_compressed(page, (path, mtime, size, coding), mime,
+                                  current, body)
+            return
+        if byte_range:
+            first, last = byte_range
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (first, last, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', mime)
+        self.send_header('Content-Length', str(last + 1 - first))
+        self.send_header('Accept-Ranges', 'bytes')
+        for header in validators:
+            self.send_header(*header)
+        self.end_headers()
 
+        if body:
+            page.seek(first)
+            self._send_file(page, last + 1 - first)
         else:
-            base = path.split('/')[1]
-            if base in apps:
-                basepath = self.server.basepath
-            else:
-                basepath = self.server.datapath
-            if not basepath:
-                self.send_error(403)
-                return
-            path = norm(os.path.join(basepath, urllib.unquote(path)[1:]))
-            if not path.startswith(basepath) or os.path.isdir(path):
-                self.send_error(403)
-                return
-            ext = os.path.splitext(path)[1].lower()
-            if ext in self.BADEXTS:
-                self.send_error(404)
-                return
-            mime = self.MIMETYPES.get(ext, self.MIMEFALLBACK)
-            try:
-                size = os.path.getsize(path)
-            except:
-                size = 0
-            try:
-                page = open(path, 'rb')
-            except IOError:
-                self.send_error(404)
-                return
-            self._ok(mime, size)
-            try:
-                while body:
-                    block = page.read(self.BUFSIZE)
+            page.close()
+
+    def _resolve(self, path):
+        """ Work out which file a URL path refers to, and return it as a
+            _Resolved.
+
+        """
+        apps = self.server.apps
+        base = path.split('/')[1]
+        if base in apps:
+            basepath = self.server.basepath
+        else:
+            basepath = self.server.datapath
+        if not basepath:
+            return _Resolved(path, 403)
+        path = norm(os.path.join(basepath, urllib.unquote(path)[1:]))
+        if not path.startswith(basepath):
+            return _Resolved(path, 403)
+        try:
+            info = os.stat(path)
+        except OSError:
+            info = None
+        if info and stat.S_ISDIR(info.st_mode):
+            return _Resolved(path, 403, stat=info)
+        ext = os.path.splitext(path)[1].lower()
+        if ext in self.BADEXTS:
+            return _Resolved(path, 404)
+        return _Resolved(path, None, ext,
+                         self.MIMETYPES.get(ext, self.MIMEFALLBACK), info)
+
+    def _send_not_modified(self, validators):
+        self.server.count('not_modified')
+        self.send_response(304)
+        for header in validators:
+            self.send_header(*header)
+        self.end_headers()
+
+    def _send_cached(self, entry, body):
+        """ Send a file from the FileCache. """
+        coding = None
+        if entry.compressible:
+            coding = self._coding()
+        etag, validators, response, header_size = entry.responses[coding]
+        if self._not_modified(etag, entry.mtime):
+            self._send_not_modified(validators)
+            return
+        size = len(response) - header_size
+        self.log_request(200, size)
+        self.wfile.write('%s 200 OK\r\nServer: %s\r\nDate: %s\r\n' %
+                         (self.protocol_version, self.version_string(),
+                          self.date_time_string()))
+        if body:
+            self.wfile.write(response)
+            self.server.count('static_bytes', size)
+        else:
+            self.wfile.write(response[:header_size])
+
+    def _send_compressed(self, page, key, mime, validators, body):
+        """ Send a file compressed, from the server's cache of 
+            compressed copies if possible. The key is the path, mtime,
+            size and coding.
+
+        """
+        data = self.server.compressed.get(key)
+        if data is None:
+            data = compress_data(page.read(), key[3])
+            self.server.compressed.put(key, data)
+        page.close()
+        self.send_response(200)
+        self.send_header('Content-Type', mime)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Content-Encoding', key[3])
+        for header in validators:
+            self.send_header(*header)
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+            self.server.count('static_bytes', len(data))
+
+    def _not_modified(self, etag, mtime):
+        """ Check If-None-Match and If-Modified-Since, to see if the 
+            client's copy is still good. If-Modified-Since only counts 
+            if there's no If-None-Match.
+
+        """
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            for tag in if_none_match.split(','):
+                tag = tag.strip()
+                if tag.startswith('W/'):
+                    tag = tag[2:]
+                if tag in (etag, '*'):
+                    return True
+            return False
+        since = self.headers.get('If-Modified-Since')
+        if since and mtime is not None:
+            since = email.utils.parsedate_tz(since.split(';')[0])
+            if since:
+                try:
+                    return mtime <= email.utils.mktime_tz(since)
+                except (TypeError, ValueError, OverflowError):
+                    pass
+        return False
+
+    def _send_file(self, page, length):
+        """ Copy length bytes from an open file, starting at its current
+            position, to the output; and close it.
+
+        """
+        try:
+            if not (self.server.use_sendfile and
+                    self._sendfile(page, length)):
+                while length > 0:
+                    block = page.read(min(self.BUFSIZE, length))
                     if not block:
                         break
                     self.wfile.write(block)
-                self.wfile.close()
-            except socket.error, msg:
-                self.log_error('socket.error %s - %s', *msg)
-            page.close()
+                    length -= len(block)
+                    self.server.count('static_bytes', len(block))
+            self.wfile.flush()
+        except socket.error, msg:
+            self.log_error('socket.error %s - %s', *msg)
+            self.close_connection = 1
+        except OSError, msg:
+            self.log_error('sendfile error %s - %s', *msg.args)
+            self.close_connection = 1
+        page.close()
+
+    def _sendfile(self, page, length):
+        """ Send length bytes of the file with sendfile(), so that the 
+            data goes straight from the file to the socket, without 
+            passing through Python. Returns False if that's not possible
+            here (in which case nothing has been sent).
+
+        """
+        try:
+            out_fd = self.wfile._sock.fileno()
+            in_fd = page.fileno()
+        except (AttributeError, ValueError, socket.error):
+            return False
+        offset = start = page.tell()
+        end = start + length
+        self.wfile.flush()
+        while offset < end:
+            try:
+                sent = sendfile(out_fd, in_fd, offset,
+                                min(SENDFILE_SIZE, end - offset))
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if offset == start and e.errno in _NOSENDFILE:
+                    return False
+                raise
+            if not sent:
+                break
+            offset += sent
+            self.server.count('static_bytes', sent)
+        return True
 
     def do_HEAD(self):
         self._page(False)
@@ -262,6 +1480,626 @@ class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
     def do_GET(self):
         self._page(True)
 
+class _Poller:
+    """ Wait for events on a set of file descriptors, with epoll, poll 
+        or select -- whichever is available, in that order.
+
+    """
+    READ = 1
+    WRITE = 4
+
+    def __init__(self):
+        self.readers = set()
+        self.writers = set()
+        self.scale = 1      # poll() takes milliseconds; the others, seconds
+        if hasattr(select, 'epoll'):
+            self.impl = select.epoll()
+        elif hasattr(select, 'poll'):
+            self.impl = select.poll()
+            self.scale = 1000
+        else:
+            self.impl = None
+
+    def register(self, fd, events):
+        if self.impl:
+            self.impl.register(fd, events)
+        else:
+            self._set(fd, events)
+
+    def modify(self, fd, events):
+        if self.impl:
+            self.impl.modify(fd, events)
+        else:
+            self._set(fd, events)
+
+    def unregister(self, fd):
+        if self.impl:
+            self.impl.unregister(fd)
+        else:
+            self._set(fd, 0)
+
+    def _set(self, fd, events):
+        self.readers.discard(fd)
+        self.writers.discard(fd)
+        if events & self.READ:
+            self.readers.add(fd)
+        if events & self.WRITE:
+            self.writers.add(fd)
+
+    def poll(self, timeout):
+        """ Return a list of (fd, events) pairs. """
+        if self.impl:
+            return self.impl.poll(timeout * self.scale)
+        r, w, x = select.select(self.readers, self.writers, [], timeout)
+        return ([(fd, self.READ) for fd in r] +
+                [(fd, self.WRITE) for fd in w])
+
+class _Connection:
+    """ A client connection in an AsyncServer's event loop. It reads 
+        until it has a complete request header, hands that to an 
+        AsyncHandler, and then sends the queued response as the socket
+        allows -- including any file, which is read a block at a time, 
+        as the previous block is sent. It serves as the handler's wfile.
+
+    """
+    MAX_HEADER = 0x10000
+
+    def __init__(self, server, sock, address):
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.fd = sock.fileno()
+        self.data = ''
+        self.keep_alive = False
+        self.out = deque()
+        self.file = None
+        self.offset = 0
+        self.remaining = 0
+        self.use_sendfile = server.use_sendfile
+        self.responding = False
+        self.last = time.time()
+
+    def write(self, data):
+        if data:
+            self.out.append(data)
+
+    def flush(self):
+        pass
+
+    def readable(self):
+        try:
+            data = self.sock.recv(Handler.BUFSIZE)
+        except socket.error, e:
+            if e.args[0] not in _WOULDBLOCK:
+                self.server.drop(self)
+            return
+        if not data:
+            self.server.drop(self)
+            return
+        self.last = time.time()
+        self.data += data
+        self.request()
+
+    def request(self):
+        """ Handle the next request, if its header is all here. """
+        match = _HEADER_END.search(self.data)
+        if not match:
+            if len(self.data) > self.MAX_HEADER:
+                self.server.drop(self)
+            return
+        request = self.data[:match.end()]
+        self.data = self.data[match.end():]
+        self.responding = True
+        try:
+            handler = AsyncHandler(self, request)
+        except Exception:
+            self.server.handle_error(self.sock, self.address)
+            self.server.drop(self)
+            return
+        if self.fd in self.server.connections:
+            self.keep_alive = not handler.close_connection
+            self.server.poller.modify(self.fd, _Poller.WRITE)
+
+    def writable(self):
+        while True:
+            if not self.out and self.file and not self.remaining:
+                self.file.close()
+                self.file = None
+            if not self.out and self.file:
+                if self.use_sendfile:
+                    try:
+                        sent = sendfile(self.fd, self.file.fileno(),
+                                        self.offset, min(SENDFILE_SIZE,
+                                                         self.remaining))
+                    except OSError, e:
+                        if e.errno in _WOULDBLOCK:
+                            return
+                        if self.offset == self.file.tell() and \
+                           e.errno in _NOSENDFILE:
+                            self.use_sendfile = False
+                            continue
+                        self.server.drop(self)
+                        return
+                    if sent:
+                        self.offset += sent
+                        self.remaining -= sent
+                        self.last = time.time()
+                        self.server.count('static_bytes', sent)
+                        continue
+                    self.file.close()
+                    self.file = None
+                else:
+                    block = self.file.read(min(Handler.BUFSIZE,
+                                               self.remaining))
+                    if block:
+                        self.out.append(block)
+                        self.remaining -= len(block)
+                        self.server.count('static_bytes', len(block))
+                    else:
+                        self.file.close()
+                        self.file = None
+            if not self.out:
+                if self.keep_alive:
+                    # Done -- wait for the next request
+                    self.responding = False
+                    self.last = time.time()
+                    self.server.poller.modify(self.fd, _Poller.READ)
+                    if self.data:
+                        self.request()
+                else:
+                    self.server.drop(self)
+                return
+            data = self.out[0]
+            try:
+                sent = self.sock.send(data)
+            except socket.error, e:
+                if e.args[0] not in _WOULDBLOCK:
+                    self.server.drop(self)
+                return
+            self.last = time.time()
+            if sent < len(data):
+                self.out[0] = data[sent:]
+                return
+            self.out.popleft()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        self.server.shutdown_request(self.sock)
+
+class AsyncServer(Server):
+    """ A Server that handles all its connections in one thread, with 
+        an event loop, instead of a thread per connection. Listings, 
+        static files and errors are sent without blocking; only HME 
+        sessions get threads of their own, since apps are written to 
+        block while waiting for events.
+
+    """
+    request_queue_size = 128
+    IDLE_TIMEOUT = 60   # Seconds to wait for a request
+    SEND_TIMEOUT = 60   # Seconds to wait for a response to make progress
+    ACCEPT_PAUSE = 0.5  # Seconds to stop accepting, when out of resources
+
+    def __init__(self, *args, **kwargs):
+        self.poller = None
+        self.connections = {}
+        self.running = False
+        self.paused = 0     # When accepting was paused, if it is
+        Server.__init__(self, *args, **kwargs)
+
+    def make_pools(self):
+        return {}
+
+    def serve_forever(self, poll_interval=0.5):
+        self.start_watcher()
+        listener = self.socket.fileno()
+        self.socket.setblocking(0)
+        self.poller = _Poller()
+        self.poller.register(listener, _Poller.READ)
+        self.running = True
+        last_sweep = time.time()
+        while self.running:
+            try:
+                events = self.poller.poll(poll_interval)
+            except (select.error, IOError), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, flags in events:
+                if fd == listener:
+                    self.accept()
+                    continue
+                conn = self.connections.get(fd)
+                if not conn:
+                    continue
+                # A failure here is this connection's, not the loop's
+                try:
+                    if conn.responding:
+                        conn.writable()
+                    else:
+                        conn.readable()
+                except Exception:
+                    self.handle_error(conn.sock, conn.address)
+                    self.drop(conn)
+            now = time.time()
+            if self.paused and now - self.paused >= self.ACCEPT_PAUSE:
+                self.paused = 0
+                self.poller.register(listener, _Poller.READ)
+            if now - last_sweep >= 1:
+                last_sweep = now
+                idle = self.keep_alive or self.IDLE_TIMEOUT
+                for conn in self.connections.values():
+                    if conn.responding:
+                        limit = self.SEND_TIMEOUT
+                    else:
+                        limit = idle
+                    if now - conn.last > limit:
+                        self.drop(conn)
+        if not self.paused:
+            self.poller.unregister(listener)
+        for conn in self.connections.values():
+            self.drop(conn)
+
+    def shutdown(self):
+        self.running = False
+
+    def accept(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error, e:
+                if e.args[0] in _WOULDBLOCK + (errno.ECONNABORTED,):
+                    return
+                if e.args[0] in _NORESOURCES:
+                    # Stop listening for a while, rather than spinning 
+                    # on connections that can't be taken yet.
+                    print time.asctime(), 'Pausing accept:', e
+                    self.poller.unregister(self.socket.fileno())
+                    self.paused = time.time()
+                    return
+                raise
+            sock.setblocking(0)
+            conn = _Connection(self, sock, address)
+            self.connections[conn.fd] = conn
+            self.poller.register(conn.fd, _Poller.READ)
+
+    def detach(self, conn):
+        """ Take a connection out of the event loop, without closing 
+            it.
+
+        """
+        self.poller.unregister(conn.fd)
+        del self.connections[conn.fd]
+
+    def drop(self, conn):
+        """ Take a connection out of the event loop, and close it. """
+        if self.connections.get(conn.fd) is conn:
+            self.detach(conn)
+        conn.close()
+
+    def get_stats(self):
+        stats = Server.get_stats(self)
+        stats['connections'] = len(self.connections)
+        return stats
+
+class AsyncHandler(Handler):
+    """ Handler for a request read by an AsyncServer. The response is 
+        queued on the connection, rather than written directly.
+
+    """
+    def __init__(self, conn, request):
+        self.conn = conn
+        self.request = conn.sock
+        self.client_address = conn.address
+        self.server = conn.server
+        self.rfile = StringIO(request)
+        self.wfile = conn
+        if not self.server.keep_alive:
+            self.protocol_version = 'HTTP/1.0'
+        self.close_connection = 1
+        self.handle_one_request()
+
+    def _send_file(self, page, length):
+        self.conn.file = page
+        self.conn.offset = page.tell()
+        self.conn.remaining = length
+
+    def _hme(self, name):
+        """ Run the session in a thread of its own. It gets a copy of 
+            this handler, so that its file objects are out of reach of 
+            the event loop, which goes on using this one.
+
+        """
+        self.server.detach(self.conn)
+        session = copy.copy(self)
+        thread = threading.Thread(target=session._run_hme, args=(name,))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _run_hme(self, name):
+        """ Run the session with the socket back in blocking mode, and 
+            ordinary file objects for it.
+
+        """
+        sock = self.request
+        sock.setblocking(1)
+        self.rfile = sock.makefile('rb', -1)
+        # Anything that came in after the request header
+        self.rfile._rbuf.write(self.conn.data)
+        self.wfile = sock.makefile('wb', self.BUFSIZE)
+        try:
+            try:
+                Handler._hme(self, name)
+                self.wfile.flush()
+            except Exception:
+                self.server.handle_error(sock, self.client_address)
+        finally:
+            self.wfile.close()
+            self.rfile.close()
+            self.server.shutdown_request(sock)
+
+class StatsServer(BaseHTTPServer.HTTPServer):
+    """ A separate HTTP server, normally bound to localhost, reporting
+        on the main server (hme_server) -- as JSON at /stats, or in 
+        Prometheus text format at /metrics.
+
+    """
+    def __init__(self, addr, handler, hme_server):
+        self.hme_server = hme_server
+        BaseHTTPServer.HTTPServer.__init__(self, addr, handler)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+class StatsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    server_version = Handler.server_version
+
+    def address_string(self):
+        return '%s:%s' % self.client_address
+
+    def version_string(self):
+        return self.server_version
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, mime, body):
+        coding = None
+        if self.server.hme_server.compress:
+            coding = pick_coding(self.headers.get('Accept-Encoding', ''))
+        if coding:
+            body = compress_data(body, coding)
+        self.send_response(200)
+        self.send_header('Content-Type', mime)
+        self.send_header('Content-Length', str(len(body)))
+        if coding:
+            self.send_header('Content-Encoding', coding)
+        if self.server.hme_server.compress:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        stats = self.server.hme_server.get_stats()
+        if path in ('', '/stats'):
+            self._send('application/json', json.dumps(stats, indent=1,
+                                                      sort_keys=True))
+        elif path == '/metrics':
+            self._send('text/plain; version=0.0.4', self.prometheus(stats))
+        else:
+            self.send_error(404)
+
+    def prometheus(self, stats):
+        """ Format the stats for Prometheus. Session counters are summed
+            by app.
+
+        """
+        lines = []
+        def metric(name, kind, values):
+            lines.append('# TYPE hme_%s %s' % (name, kind))
+            for labels, value in values:
+                text = ''
+                if labels:
+                    text = '{%s}' % ','.join('%s="%s"' % label
+                                             for label in labels)
+                lines.append('hme_%s%s %s' % (name, text, value))
+
+        counts = stats['counts']
+        metric('uptime_seconds', 'gauge', [((), stats['uptime'])])
+        metric('threads', 'gauge', [((), stats['threads'])])
+        if stats['zeroconf_ready'] is not None:
+            metric('zeroconf_ready', 'gauge',
+                   [((), int(stats['zeroconf_ready']))])
+            metric('zeroconf_failed', 'gauge',
+                   [((), int(stats['zeroconf_error'] is not None))])
+        metric('requests_total', 'counter',
+               [((('kind', name.split('.', 1)[1]),), value)
+                for name, value in sorted(counts.items())
+                if name.startswith('requests.')])
+        metric('errors_total', 'counter', [((), counts.get('errors', 0))])
+        metric('rejected_total', 'counter',
+               [((('pool', name.split('.', 1)[1]),), value)
+                for name, value in sorted(counts.items())
+                if name.startswith('rejected.')])
+        for key in ('busy', 'queued'):
+            metric('pool_' + key, 'gauge',
+                   [((('pool', name),), pool[key])
+                    for name, pool in sorted(stats['pools'].items())])
+        metric('static_bytes_total', 'counter',
+               [((), counts.get('static_bytes', 0))])
+        metric('cache_hits_total', 'counter',
+               [((('cache', name),), cache['hits'])
+                for name, cache in sorted(stats['caches'].items())])
+        metric('cache_misses_total', 'counter',
+               [((('cache', name),), cache['misses'])
+                for name, cache in sorted(stats['caches'].items())])
+        metric('sessions', 'gauge',
+               [((('app', name),), value)
+                for name, value in sorted(stats['sessions_by_app'].items())])
+
+        apps = {}
+        for session in stats['sessions']:
+            totals = apps.setdefault(session['app'], {})
+            s = session['stats']
+            for key, value in (('commands', sum(s['commands'].values())),
+                               ('bytes', s['bytes']),
+                               ('flushes', s['flushes']),
+                               ('events', sum(s['events'].values())),
+                               ('handler_seconds',
+                                sum(s['handler_time'].values())),
+                               ('views', s['views']),
+                               ('resources', sum(s['resources'].values()))):
+                totals[key] = totals.get(key, 0) + value
+        for key in ('commands', 'bytes', 'flushes', 'events',
+                    'handler_seconds', 'views', 'resources'):
+            metric('session_' + key, 'gauge',
+                   [((('app', name),), totals[key])
+                    for name, totals in sorted(apps.items())])
+        return '\n'.join(lines) + '\n'
+
+def serve(httpd, index=0):
+    """ Run a server, with its stats server if it has one, until 
+        interrupted. With several (in a Prefork), the stats server for 
+        each is on the next port after the last.
+
+    """
+    stats = None
+    stats_port = httpd.option('statsport', 0)
+    if stats_port:
+        stats = StatsServer((httpd.option('statsaddress', '127.0.0.1'),
+                             stats_port + index), StatsHandler, httpd)
+        stats.start()
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        if stats:
+            stats.shutdown()
+
+class Prefork:
+    """ Run a server in several worker processes, so that apps can use
+        more than one CPU. With SO_REUSEPORT, each worker opens its own
+        listening socket, and the kernel spreads connections among them;
+        otherwise, the socket is opened here, and shared. Workers that 
+        die are restarted -- after a longer wait each time one fails 
+        right after starting, until it's done so MAX_FAILURES times in a
+        row, when the supervisor gives up. Stopping the supervisor, with
+        ^C or SIGTERM, stops the workers; and if it dies, they exit.
+
+    """
+    RESTART_DELAY = 1   # Seconds to wait before restarting a worker
+    STARTUP_TIME = 5    # A worker that exits sooner than this failed
+    MAX_FAILURES = 5
+
+    def __init__(self, count, server_class, args, reuse_port=True):
+        self.count = count
+        self.server_class = server_class
+        self.args = args
+        self.httpd = None
+        if reuse_port:
+            # Only the workers listen, but try binding here first, so 
+            # that a port that's in use is reported once, at startup.
+            server_class(*args, reuse_port=True).server_close()
+        else:
+            self.httpd = server_class(*args)
+        self.workers = {}    # pid -> (index, start time)
+        self.failures = {}   # index -> failed starts in a row
+        self.inherited = []  # Sockets of the supervisor's, to close
+        self.running = False
+
+    def spawn(self, index):
+        parent = os.getpid()
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = (index, time.time())
+            return
+
+        # In the worker -- ^C is left to the supervisor
+        status = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            watcher = threading.Thread(target=self.watch_parent,
+                                       args=(parent,))
+            watcher.setDaemon(True)
+            watcher.start()
+            for sock in self.inherited:
+                sock.close()
+            httpd = self.httpd
+            if not httpd:
+                httpd = self.server_class(*self.args, reuse_port=True)
+            serve(httpd, index)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        os._exit(status)
+
+    def watch_parent(self, parent):
+        """ In a worker, exit if the supervisor goes away. """
+        while os.getppid() == parent:
+            time.sleep(1)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def start(self):
+        """ Start the workers, and have SIGTERM stop them. """
+        self.running = True
+        signal.signal(signal.SIGTERM, self.terminate)
+        for index in xrange(self.count):
+            self.spawn(index)
+
+    def terminate(self, signum, frame):
+        self.shutdown()
+
+    def run(self):
+        """ Restart the workers as needed, until interrupted, or until 
+            one keeps failing.
+
+        """
+        while self.running:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno in (errno.EINTR, errno.ECHILD):
+                    continue
+                raise
+            if pid not in self.workers:
+                continue
+            index, started = self.workers.pop(pid)
+            if not self.running:
+                break
+            failures = 0
+            if time.time() - started < self.STARTUP_TIME:
+                failures = self.failures.get(index, 0) + 1
+            self.failures[index] = failures
+            if failures >= self.MAX_FAILURES:
+                print 'Worker %d keeps failing, giving up' % index
+                self.shutdown()
+                break
+            print 'Worker %d (pid %d) exited, restarting' % (index, pid)
+            time.sleep(self.RESTART_DELAY * 2 ** failures)
+            if self.running:
+                self.spawn(index)
+
+    def shutdown(self):
+        self.running = False
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.workers:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.workers.clear()
+        if self.httpd:
+            self.httpd.server_close()
+
 class ZCListener:
     def __init__(self, names):
         self.names = names
@@ -273,26 +2111,59 @@ class ZCListener:
         self.names.append(name.replace('.' + type, ''))
 
 class ZCBroadcast:
+    """ Announce the apps via Zeroconf. This is done in the background, 
+        so that the server can answer requests in the meantime; the apps
+        are probed and announced all at once, in shared packets, and 
+        ready is set when that's done. If it fails, error says why.
+
+    """
     def __init__(self, addr, apps):
         host, port = addr
+        self.port = port
         self.apps = apps
         self.appinfo = []
-        host_ip = self.get_address(host)
+        self.registered = []
+        self.error = None
+        self.ready = threading.Event()
+        self.host_ip = self.get_address(host)
         self.rz = zeroconf.Zeroconf()
+        self.thread = threading.Thread(target=self.register)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def register(self):
+        """ Register all the apps, and then set ready. """
+        try:
+            self.register_apps()
+        except Exception, e:
+            self.error = e.__class__.__name__
+            if str(e):
+                self.error += ': %s' % e
+            print 'Zeroconf failed:', self.error
+            return
+        self.registered = self.appinfo
+        self.ready.set()
+        print 'Zeroconf ready'
+
+    def register_apps(self):
+        """ Give each app a title not already in use, and register 
+            them.
+
+        """
         old_titles = self.find_hme()
-        for name in sorted(apps):
+        for name in sorted(self.apps):
             print 'Registering:', name
-            desc = {'path': apps[name]['url'], 'version': HME_VERSION}
-            title = orgtitle = apps[name]['title'].replace(' ', u'\xa0')
+            desc = {'path': self.apps[name]['url'], 'version': HME_VERSION}
+            title = orgtitle = self.apps[name]['title'].replace(' ', u'\xa0')
             count = 1
             while title in old_titles:
                 count += 1
                 title = u'%s\xa0[%d]' % (orgtitle, count)
 
             info = zeroconf.ServiceInfo(HME_ZC, '%s.%s' % (title, HME_ZC),
-                                        host_ip, port, 0, 0, desc)
-            self.rz.registerService(info)
+                                        self.host_ip, self.port, 0, 0, desc)
             self.appinfo.append(info)
+        self.rz.registerServices(self.appinfo)
 
     def find_hme(self):
         """ Get the titles of running HME apps. """
@@ -306,9 +2177,10 @@ class ZCBroadcast:
         return titles
 
     def shutdown(self):
-        print 'Unregistering:', ' '.join(sorted(self.apps))
-        for info in self.appinfo:
-            self.rz.unregisterService(info)
+        self.thread.join()
+        if self.registered:
+            print 'Unregistering:', ' '.join(sorted(self.apps))
+            self.rz.unregisterServices(self.registered)
         self.rz.close()
 
     def get_address(self, host):
@@ -360,6 +2232,9 @@ if __name__ == '__main__':
 
     have_zc = True
     beacon_ips = ''
+    server_class = Server
+    workers = 0
+    reuse_port = True
     applist = []
     opts = []
 
@@ -383,6 +2258,13 @@ if __name__ == '__main__':
                 beacon_ips = value
             elif opt == 'zeroconf':
                 have_zc = config.getboolean('hmeserver', 'zeroconf')
+            elif opt == 'eventloop':
+                if config.getboolean('hmeserver', 'eventloop'):
+                    server_class = AsyncServer
+            elif opt == 'workers':
+                workers = int(value)
+            elif opt == 'reuseport':
+                reuse_port = config.getboolean('hmeserver', 'reuseport')
 
     try:
         opts, applist = getopt.getopt(sys.argv[1:], 'a:p:b:d:i:zvh',
@@ -450,20 +2332,49 @@ if __name__ == '__main__':
                               'genre': 'other'}
                 if config.has_section(name):
                     apps[name].update(dict(config.items(name)))
+                # Set last, so that config keys can't replace them
+                apps[name]['appclass'] = appclass
+                apps[name]['factory'] = getattr(app, 'FACTORY', appclass)
+
+    if workers and not hasattr(os, 'fork'):
+        print 'Not using workers: no fork() on this system'
+        workers = 0
+    if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+        reuse_port = False
 
     print time.asctime(), 'Server Starts'
-    httpd = Server((host, port), Handler, app_root, data_root, apps, config)
+    args = ((host, port), Handler, app_root, data_root, apps, config)
+    if workers:
+        supervisor = Prefork(workers, server_class, args, reuse_port)
+        supervisor.start()
+    else:
+        httpd = server_class(*args)
+
+    # Announcements come from here, not from the workers. They're made 
+    # in the background, now that the socket is listening. (Workers are
+    # started first, so that they aren't forked with these threads 
+    # running; restarted ones close the sockets they inherit.)
     if have_zc:
         zc = ZCBroadcast((host, port), apps)
+        if workers:
+            supervisor.inherited.append(zc.rz.socket)
+        else:
+            httpd.zeroconf = zc
     if beacon_ips:
         bc = Beacon(port, beacon_ips)
+        if workers:
+            supervisor.inherited.append(bc.UDPSock)
         bc.start()
     try:
-        httpd.serve_forever()
+        if workers:
+            supervisor.run()
+        else:
+            serve(httpd)
     except KeyboardInterrupt:
-        httpd.server_close()
-        if have_zc:
-            zc.shutdown()
-        if beacon_ips:
-            bc.stop()
+        if workers:
+            supervisor.shutdown()
+    if have_zc:
+        zc.shutdown()
+    if beacon_ips:
+        bc.stop()
     print time.asctime(), 'Server Stops'
@@ -54,7 +54,7 @@ _MDNS_PORT = 5353
 _DNS_PORT = 53
 _DNS_TTL = 60 * 60 # one hour default TTL
 
-_MAX_MSG_TYPICAL = 1460 # unused
+_MAX_MSG_TYPICAL = 1460
 _MAX_MSG_ABSOLUTE = 8972
 
 _FLAGS_QR_MASK = 0x8000 # query response mask
@@ -174,6 +174,10 @@ class DNSEntry(object):
         """Non-equality test"""
         return not self.__eq__(other)
 
+    def __hash__(self):
+        """Hash consistent with equality"""
+        return hash((self.name, self.type, self.clazz))
+
     def getClazz(self, clazz):
         """Class accessor"""
         return _CLASSES.get(clazz, "?(%s)" % clazz)
@@ -289,6 +293,10 @@ class DNSAddress(DNSRecord):
         """Tests equality on address"""
         return isinstance(other, DNSAddress) and self.address == other.address
 
+    def __hash__(self):
+        """Hash consistent with equality"""
+        return hash(self.address)
+
     def __repr__(self):
         """String representation"""
         try:
@@ -314,6 +322,10 @@ class DNSHinfo(DNSRecord):
         return (isinstance(other, DNSHinfo) and
                 self.cpu == other.cpu and self.os == other.os)
 
+    def __hash__(self):
+        """Hash consistent with equality"""
+        return hash((self.cpu, self.os))
+
     def __repr__(self):
         """String representation"""
         return self.cpu + " " + self.os
@@ -333,6 +345,10 @@ class DNSPointer(DNSRecord):
         """Tests equality on alias"""
         return isinstance(other, DNSPointer) and self.alias == other.alias
 
+    def __hash__(self):
+        """Hash consistent with equality"""
+        return hash(self.alias)
+
     def __repr__(self):
         """String representation"""
         return self.toString(self.alias)
@@ -352,6 +368,10 @@ class DNSText(DNSRecord):
         """Tests equality on text"""
         return isinstance(other, DNSText) and self.text == other.text
 
+    def __hash__(self):
+        """Hash consistent with equality"""
+        return hash(self.text)
+
     def __repr__(self):
         """String representation"""
         if len(self.text) > 10:
@@ -384,6 +404,10 @@ class DNSService(DNSRecord):
                 self.port == other.port and
                 self.server == other.server)
 
+    def __hash__(self):
+        """Hash consistent with equality"""
+        return hash((self.priority, self.weight, self.port, self.server))
+
     def __repr__(self):
         """String representation"""
         return self.toString("%s:%s" % (self.server, self.port))
@@ -683,56 +707,71 @@ class DNSOutgoing(object):
 
 
 class DNSCache(object):
-    """A cache of DNS entries"""
+    """A cache of DNS entries, indexed by name, by name, type and class,
+    and by identity -- name, type, class and data -- so that adding,
+    removing and looking up an entry take constant time."""
 
     def __init__(self):
-        self.cache = {}
+        self.cache = {}      # name -> {identity: entry}
+        self.details = {}    # (name, type, class) -> {identity: entry}
+        self.records = {}    # identity -> entry
+        self.lock = threading.Lock()
+
+    def identity(self, entry):
+        """Returns the key under which an entry is stored.  The entry's
+        own equality covers its data; the name, type and class are added
+        since not every kind of record compares those."""
+        return (entry.key, entry.type, entry.clazz, entry)
 
     def add(self, entry):
-        """Adds an entry"""
-        try:
-            list = self.cache[entry.key]
-        except:
-            list = self.cache[entry.key] = []
-        list.append(entry)
+        """Adds an entry, replacing any equal one"""
+        key = self.identity(entry)
+        self.lock.acquire()
+        self.removeKey(key)
+        self.records[key] = entry
+        self.cache.setdefault(entry.key, {})[key] = entry
+        self.details.setdefault(key[:3], {})[key] = entry
+        self.lock.release()
 
     def remove(self, entry):
         """Removes an entry"""
-        try:
-            list = self.cache[entry.key]
-            list.remove(entry)
-        except:
-            pass
+        self.lock.acquire()
+        self.removeKey(self.identity(entry))
+        self.lock.release()
+
+    def removeKey(self, key):
+        """Removes an entry by identity, with the lock held"""
+        if self.records.pop(key, None) is None:
+            return
+        for index, name in ((self.cache, key[0]), (self.details, key[:3])):
+            entries = index[name]
+            del entries[key]
+            if not entries:
+                del index[name]
 
     def get(self, entry):
         """Gets an entry by key.  Will return None if there is no
         matching entry."""
-        try:
-            list = self.cache[entry.key]
-            return list[list.index(entry)]
-        except:
-            return None
+        return self.records.get(self.identity(entry))
 
     def getByDetails(self, name, type, clazz):
         """Gets an entry by details.  Will return None if there is
         no matching entry."""
-        entry = DNSEntry(name, type, clazz)
-        return self.get(entry)
+        try:
+            return self.details[(name.lower(), type, clazz)].values()[0]
+        except (KeyError, IndexError):
+            return None
 
     def entriesWithName(self, name):
         """Returns a list of entries whose key matches the name."""
         try:
-            return self.cache[name]
-        except:
+            return self.cache[name.lower()].values()
+        except KeyError:
             return []
 
     def entries(self):
         """Returns a list of all entries"""
-        def add(x, y): return x + y
-        try:
-            return reduce(add, self.cache.values())
-        except:
-            return []
+        return self.records.values()
 
 
 class Engine(threading.Thread):
@@ -1265,67 +1304,115 @@ class Zeroconf(object):
         of 60 seconds.  Zeroconf will then respond to requests for
         information for that service.  The name of the service may be
         changed if needed to make it unique on the network."""
-        self.checkService(info)
-        self.services[info.name.lower()] = info
-        if info.type in self.servicetypes:
-            self.servicetypes[info.type] += 1
-        else:
-            self.servicetypes[info.type] = 1
-        now = currentTimeMillis()
-        nextTime = now
-        i = 0
-        while i < 3:
-            if now < nextTime:
-                self.wait(nextTime - now)
-                now = currentTimeMillis()
-                continue
-            out = DNSOutgoing(_FLAGS_QR_RESPONSE | _FLAGS_AA)
-            out.addAnswerAtTime(DNSPointer(info.type, _TYPE_PTR,
-                _CLASS_IN, ttl, info.name), 0)
-            out.addAnswerAtTime(DNSService(info.name, _TYPE_SRV,
-                _CLASS_IN, ttl, info.priority, info.weight, info.port,
-                info.server), 0)
-            out.addAnswerAtTime(DNSText(info.name, _TYPE_TXT, _CLASS_IN,
-                ttl, info.text), 0)
-            if info.address:
-                out.addAnswerAtTime(DNSAddress(info.server, _TYPE_A,
-                    _CLASS_IN, ttl, info.address), 0)
-            self.send(out)
-            i += 1
-            nextTime += _REGISTER_TIME
+        self.registerServices([info], ttl)
+
+    def registerServices(self, infos, ttl=_DNS_TTL):
+        """Registers several services at once.  They're probed for and
+        announced together, with the records for all of them packed
+        into as few packets as will hold them, so this takes no longer
+        than registering one service."""
+        self.checkServices(infos)
+        # Services may be registered from several threads at once
+        self.condition.acquire()
+        for info in infos:
+            self.services[info.name.lower()] = info
+            if info.type in self.servicetypes:
+                self.servicetypes[info.type] += 1
+            else:
+                self.servicetypes[info.type] = 1
+        self.condition.release()
+        self.sendGroups(_FLAGS_QR_RESPONSE | _FLAGS_AA,
+                        [self.serviceRecords(info, ttl) for info in infos],
+                        3, _REGISTER_TIME)
 
     def unregisterService(self, info):
         """Unregister a service."""
-        try:
-            del(self.services[info.name.lower()])
-            if self.servicetypes[info.type] > 1:
-                self.servicetypes[info.type] -= 1
-            else:
-                del self.servicetypes[info.type]
-        except:
-            pass
+        self.unregisterServices([info])
+
+    def unregisterServices(self, infos):
+        """Unregister several services at once, in as few packets as
+        will hold them."""
+        self.condition.acquire()
+        for info in infos:
+            try:
+                del(self.services[info.name.lower()])
+                if self.servicetypes[info.type] > 1:
+                    self.servicetypes[info.type] -= 1
+                else:
+                    del self.servicetypes[info.type]
+            except:
+                pass
+        self.condition.release()
+        self.sendGroups(_FLAGS_QR_RESPONSE | _FLAGS_AA,
+                        [self.serviceRecords(info, 0) for info in infos],
+                        3, _UNREGISTER_TIME)
+
+    def serviceRecords(self, info, ttl):
+        """Returns the records announcing a service, with the given TTL
+        (0 to withdraw it), as a group for sendGroups()."""
+        records = [('answer', DNSPointer(info.type, _TYPE_PTR, _CLASS_IN,
+                                         ttl, info.name)),
+                   ('answer', DNSService(info.name, _TYPE_SRV, _CLASS_IN,
+                                         ttl, info.priority, info.weight,
+                                         info.port, info.server)),
+                   ('answer', DNSText(info.name, _TYPE_TXT, _CLASS_IN, ttl,
+                                      info.text))]
+        if info.address:
+            records.append(('answer', DNSAddress(info.server, _TYPE_A,
+                                                 _CLASS_IN, ttl,
+                                                 info.address)))
+        return records
+
+    def sendGroups(self, flags, groups, times=1, interval=0):
+        """Sends groups of records, packed into as few packets as will
+        hold them, each no bigger than _MAX_MSG_TYPICAL (unless a
+        single group is bigger than that).  Each group is a list of
+        (section, record) pairs, where the section is 'question',
+        'answer' or 'authority', and is never split between packets;
+        questions repeated within a packet are sent only once.  The
+        whole lot is sent the given number of times, interval
+        milliseconds apart."""
+        def build(batch):
+            out = DNSOutgoing(flags)
+            for group in batch:
+                for section, record in group:
+                    if section == 'question':
+                        if record not in out.questions:
+                            out.addQuestion(record)
+                    elif section == 'answer':
+                        out.addAnswerAtTime(record, 0)
+                    else:
+                        out.addAuthorativeAnswer(record)
+            return out
+
+        # Name compression only makes a group smaller when it shares a
+        # packet, so its size alone is an upper bound.
+        batches = []
+        batch = []
+        size = 12
+        for group in groups:
+            length = len(build([group]).packet()) - 12
+            if batch and size + length > _MAX_MSG_TYPICAL:
+                batches.append(batch)
+                batch = []
+                size = 12
+            batch.append(group)
+            size += length
+        if batch:
+            batches.append(batch)
+
         now = currentTimeMillis()
         nextTime = now
         i = 0
-        while i < 3:
+        while i < times:
             if now < nextTime:
                 self.wait(nextTime - now)
                 now = currentTimeMillis()
                 continue
-            out = DNSOutgoing(_FLAGS_QR_RESPONSE | _FLAGS_AA)
-            out.addAnswerAtTime(DNSPointer(info.type, _TYPE_PTR,
-                _CLASS_IN, 0, info.name), 0)
-            out.addAnswerAtTime(DNSService(info.name, _TYPE_SRV,
-                _CLASS_IN, 0, info.priority, info.weight, info.port,
-                info.name), 0)
-            out.addAnswerAtTime(DNSText(info.name, _TYPE_TXT, _CLASS_IN,
-                0, info.text), 0)
-            if info.address:
-                out.addAnswerAtTime(DNSAddress(info.server, _TYPE_A,
-                    _CLASS_IN, 0, info.address), 0)
-            self.send(out)
+            for batch in batches:
+                self.send(build(batch))
             i += 1
-            nextTime += _UNREGISTER_TIME
+            nextTime += interval
 
     def unregisterAllServices(self):
         """Unregister all registered services."""
@@ -1385,6 +1472,40 @@ class Zeroconf(object):
             i += 1
             nextTime += _CHECK_TIME
 
+    def checkServices(self, infos):
+        """Checks the network for unique names for several services at
+        once, modifying the ServiceInfos passed in as checkService()
+        does.  The probes for all of them are sent together."""
+        now = currentTimeMillis()
+        nextTime = now
+        i = 0
+        while i < 3:
+            for info in infos:
+                for record in self.cache.entriesWithName(info.type):
+                    if (record.type == _TYPE_PTR and
+                        not record.isExpired(now) and
+                        record.alias == info.name):
+                        if info.name.find('.') < 0:
+                            info.name = '%s.[%s:%s].%s' % (info.name,
+                                info.address, info.port, info.type)
+
+                            self.checkServices(infos)
+                            return
+                        raise NonUniqueNameException
+            if now < nextTime:
+                self.wait(nextTime - now)
+                now = currentTimeMillis()
+                continue
+            self.sendGroups(_FLAGS_QR_QUERY | _FLAGS_AA,
+                            [[('question', DNSQuestion(info.type, _TYPE_PTR,
+                                                       _CLASS_IN)),
+                              ('authority', DNSPointer(info.type, _TYPE_PTR,
+                                                       _CLASS_IN, _DNS_TTL,
+                                                       info.name))]
+                             for info in infos])
+            i += 1
+            nextTime += _CHECK_TIME
+
     def addListener(self, listener, question):
         """Adds a listener for a given question.  The listener will have
         its updateRecord method called when information is available to
@@ -1418,14 +1539,13 @@ class Zeroconf(object):
         now = currentTimeMillis()
         for record in msg.answers:
             expired = record.isExpired(now)
-            if record in self.cache.entries():
+            entry = self.cache.get(record)
+            if entry is not None:
                 if expired:
                     self.cache.remove(record)
                 else:
-                    entry = self.cache.get(record)
-                    if entry is not None:
-                        entry.resetTTL(record)
-                        record = entry
+                    entry.resetTTL(record)
+                    record = entry
             else:
                 self.cache.add(record)
 